@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import base64
+import uuid
+import random
+import shlex
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+
+from harness import ROOT, Recorder, free_port, peak_rss_mb, print_report, start_app
+from shared import stub_proxy
+
+# Генератор нагрузки на маршруты API-сервера. Сервер запускается отдельным
+# процессом (Flask, aiohttp или своя команда) с GAS_PROXY_URL на заглушку
+# shared.stub_proxy, которая работает в процессе бенчмарка. Клиенты держат
+# --concurrency запросов одновременно, пока не отправят --requests.
+#
+#   python bench/api_bench.py --route chat --concurrency 64 --requests 2000
+#   python bench/api_bench.py --server aiohttp --route upload --file-size 2000000
+#   python bench/api_bench.py --server aiohttp --route upload_binary --file-size 2000000
+#   python bench/api_bench.py --url http://127.0.0.1:5000 --route stream   # уже запущенный сервер
+
+SERVERS = {
+    # Встроенный сервер Flask многопоточный; для продакшен-цифр — gunicorn через --server-cmd
+    "flask": "{python} -c \"import server; server.app.run(host='127.0.0.1', port={port}, threaded=True)\"",
+    "aiohttp": "{python} async_server.py",
+}
+
+
+def _multipart(fields: dict, file_bytes: bytes, mime_type: str) -> dict:
+    """Тело multipart/form-data как у браузерного FormData: у частей нет Content-Length."""
+    boundary = "----BenchFormBoundary" + uuid.uuid4().hex
+    body = bytearray()
+    for name, value in fields.items():
+        body += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                 f"{value}\r\n").encode("utf-8")
+    body += (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"bench\"\r\n"
+             f"Content-Type: {mime_type}\r\n\r\n").encode("utf-8")
+    body += file_bytes
+    body += f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return {"data": bytes(body), "headers": {"Content-Type": f"multipart/form-data; boundary={boundary}"}}
+
+
+def _request(route: str, index: int, args, file_bytes: bytes, file_data: str):
+    """(путь, аргументы session.post) запроса номер index для маршрута route."""
+    user_id = f"bench-{index % args.users}"
+    message = f"Вопрос {index}: объясни пример кода"
+    # Номер в вопросе к файлу: одинаковые одновременные запросы клиент объединил бы в один
+    file_prompt = f"Что в этом файле? ({index})"
+    if route == "chat":
+        return "/api/chat", {"json": {"user_id": user_id, "message": message}}
+    if route == "stream":
+        return "/api/chat/stream", {"json": {"user_id": user_id, "message": message}}
+    if route == "upload":
+        return "/api/upload", {"json": {"user_id": user_id, "file_data": file_data, "mime_type": args.file_mime,
+                                        "prompt": file_prompt}}
+    if route == "upload_binary":
+        return "/api/upload/binary", _multipart({"user_id": user_id, "prompt": file_prompt},
+                                                file_bytes, args.file_mime)
+    if route == "batch":
+        items = [{"id": n, "message": f"{message} (пункт {n})"} for n in range(args.batch_size)]
+        return "/api/batch", {"json": {"items": items}}
+    raise ValueError(route)
+
+
+async def _send(session: aiohttp.ClientSession, url: str, route: str, request: dict) -> str:
+    async with session.post(url, **request) as r:
+        if r.status != 200:
+            await r.read()
+            return str(r.status)
+        if route == "stream":
+            # Поток дочитывается до конца: задержка — до полного ответа
+            async for line in r.content:
+                if line.startswith(b"data:") and b'"error"' in line:
+                    return "stream_error"
+            return "ok"
+        data = await r.json()
+        if route == "batch":
+            failed = [item for item in data["results"] if "error" in item]
+            return "item_error" if failed else "ok"
+        return "ok"
+
+
+async def run_load(base_url: str, args) -> Recorder:
+    rng = random.Random(args.seed)
+    routes = args.route.split(",")
+    file_bytes = rng.randbytes(args.file_size) if {"upload", "upload_binary"} & set(routes) else b""
+    file_data = base64.b64encode(file_bytes).decode("ascii") if "upload" in routes else ""
+    recorder = Recorder()
+    counter = iter(range(args.requests))
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def client():
+            for index in counter:
+                route = routes[index % len(routes)]
+                path, request = _request(route, index, args, file_bytes, file_data)
+                started = time.perf_counter()
+                try:
+                    outcome = await _send(session, base_url + path, route, request)
+                except asyncio.TimeoutError:
+                    outcome = "timeout"
+                except aiohttp.ClientError as e:
+                    outcome = type(e).__name__
+                recorder.add(time.perf_counter() - started, outcome)
+
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    return recorder
+
+
+async def wait_healthy(base_url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise SystemExit(f"Сервер завершился с кодом {process.returncode}")
+            try:
+                async with session.get(f"{base_url}/health") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit("Сервер не ответил на /health")
+
+
+async def run(args):
+    proxy_config = stub_proxy.parse_args(shlex.split(args.proxy))
+    proxy_port = free_port()
+    proxy = await start_app(stub_proxy.create_app(proxy_config), proxy_port)
+
+    process = None
+    base_url = args.url.rstrip("/") if args.url else None
+    try:
+        if base_url is None:
+            port = free_port()
+            command = (args.server_cmd or SERVERS[args.server]).format(python=shlex.quote(sys.executable), port=port)
+            env = dict(os.environ, PORT=str(port), GAS_PROXY_URL=f"http://127.0.0.1:{proxy_port}/")
+            env.setdefault("GEMINI_CACHE", "off")
+            # Без shell: pid должен быть pid самого сервера, чтобы снять его пиковый RSS
+            process = subprocess.Popen(shlex.split(command), cwd=os.path.join(ROOT, "server"), env=env)
+            base_url = f"http://127.0.0.1:{port}"
+            await wait_healthy(base_url, process)
+        else:
+            print(f"Сервер {base_url} должен использовать GAS_PROXY_URL=http://127.0.0.1:{proxy_port}/ "
+                  f"или свой прокси")
+
+        started = time.perf_counter()
+        recorder = await run_load(base_url, args)
+        elapsed = time.perf_counter() - started
+
+        rss = {"генератор нагрузки": peak_rss_mb()}
+        if process is not None:
+            rss["сервер"] = peak_rss_mb(process.pid)
+        print_report(f"API: {args.route}, {args.concurrency} одновременно", recorder, elapsed, rss)
+        print("заглушка прокси: " + json.dumps(proxy.app["stats"], ensure_ascii=False))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        await proxy.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Генератор нагрузки на API-сервер")
+    parser.add_argument("--route", default="chat",
+                        help="chat, stream, upload, upload_binary, batch или несколько через запятую (по очереди)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--users", type=int, default=100, help="различных user_id")
+    parser.add_argument("--file-mime", default="text/plain")
+    parser.add_argument("--file-size", type=int, default=100 * 1024, help="размер файла для upload, байт")
+    parser.add_argument("--batch-size", type=int, default=10, help="пунктов в одном запросе batch")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--server", choices=sorted(SERVERS), default="flask")
+    parser.add_argument("--server-cmd", help="своя команда запуска сервера из каталога server/ ({python}, {port})")
+    parser.add_argument("--url", help="не запускать сервер, а нагружать уже работающий")
+    parser.add_argument("--proxy", default="--delay 0.5",
+                        help="аргументы заглушки прокси (см. python -m shared.stub_proxy --help)")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
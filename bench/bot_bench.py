@@ -0,0 +1,229 @@
+import io
+import os
+import sys
+import time
+import random
+import shlex
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from harness import ROOT, Recorder, free_port, peak_rss_mb, print_report, print_stages, start_app
+from shared import stub_proxy
+
+# Нагрузочный тест бота без Telegram и Gemini: обработчики handle_text/handle_files
+# вызываются напрямую с поддельными обновлениями, Bot API заменён объектами с
+# задержкой --telegram-delay, файлы отдаёт локальный HTTP-сервер, Gemini — заглушка
+# shared.stub_proxy в этом же процессе. Чаты шлют сообщения параллельно, внутри
+# чата — по очереди, как их обрабатывает бот.
+#
+#   python bench/bot_bench.py --chats 50 --messages 4 --files 0.25
+#   python bench/bot_bench.py --proxy "--latency lognormal --delay 1.5 --jitter 0.5 --error-rate 0.02"
+
+ERROR_PREFIXES = ("❌", "⏳", "⚠️", "Ошибка", "Общая ошибка")
+
+
+class FakeTelegram:
+    """Bot API в памяти: считает вызовы и отвечает через delay секунд."""
+
+    def __init__(self, delay: float, files_url: str):
+        self.delay = delay
+        self.files_url = files_url
+        self.calls = Counter()
+        self._message_id = 0
+        self.bot = FakeBot(self)
+
+    def next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    async def call(self, method: str):
+        self.calls[method] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+
+class FakeBot:
+    def __init__(self, telegram: FakeTelegram):
+        self.telegram = telegram
+
+    async def get_me(self):
+        await self.telegram.call("getMe")
+        return SimpleNamespace(username="bench_bot")
+
+    async def get_file(self, file_id: str):
+        await self.telegram.call("getFile")
+        return SimpleNamespace(file_path=f"{self.telegram.files_url}/{file_id}")
+
+    async def set_my_commands(self, *args, **kwargs):
+        await self.telegram.call("setMyCommands")
+
+
+class FakeChat:
+    def __init__(self, telegram: FakeTelegram, chat_id: int):
+        self.telegram = telegram
+        self.id = chat_id
+        self.type = "private"
+        self.last_text = ""
+
+    async def send_action(self, action=None):
+        await self.telegram.call("sendChatAction")
+
+
+class FakeMessage:
+    def __init__(self, telegram: FakeTelegram, chat: FakeChat, text=None, caption=None, document=None):
+        self.telegram = telegram
+        self.chat = chat
+        self.message_id = telegram.next_message_id()
+        self.text = text
+        self.caption = caption
+        self.document = document
+        self.photo = None
+        self.media_group_id = None
+
+    @property
+    def chat_id(self) -> int:
+        return self.chat.id
+
+    async def reply_text(self, text: str, **kwargs):
+        await self.telegram.call("sendMessage")
+        self.chat.last_text = text
+        return FakeMessage(self.telegram, self.chat, text=text)
+
+    async def edit_text(self, text: str, **kwargs):
+        await self.telegram.call("editMessageText")
+        self.text = self.chat.last_text = text
+        return self
+
+
+def make_file(mime_type: str, size: int, rng: random.Random) -> bytes:
+    """Содержимое файла нужного типа примерно заданного размера."""
+    if mime_type == "text/plain":
+        words = ("строка", "документа", "для", "теста", "нагрузки", "и", "разбора", "по", "частям.", "\n")
+        text = " ".join(rng.choice(words) for _ in range(size // 6))
+        return text.encode("utf-8")[:size]
+    if mime_type in ("image/jpeg", "image/png"):
+        try:
+            from PIL import Image
+        except ImportError:
+            return rng.randbytes(size)
+        # Шум плохо сжимается: сторона подбирается так, чтобы файл был порядка size
+        side = max(int((size / 3) ** 0.5), 16)
+        image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+        out = io.BytesIO()
+        image.save(out, "JPEG" if mime_type == "image/jpeg" else "PNG")
+        return out.getvalue()
+    return rng.randbytes(size)
+
+
+async def run_chat(bot, telegram: FakeTelegram, index: int, args, files: dict, rng: random.Random,
+                   recorder: Recorder):
+    chat = FakeChat(telegram, 100000 + index)
+    update_user = SimpleNamespace(id=chat.id)
+    context = SimpleNamespace(bot=telegram.bot)
+
+    for n in range(args.messages):
+        if rng.random() < args.files:
+            name = f"file-{index}-{n}"
+            unique_id = "same-file" if args.same_file else name
+            files[name] = make_file(args.file_mime, args.file_size, rng)
+            document = SimpleNamespace(file_id=name, file_unique_id=unique_id, mime_type=args.file_mime,
+                                       file_size=len(files[name]))
+            message = FakeMessage(telegram, chat, caption="Что в этом файле?", document=document)
+            handler = bot.handle_files
+        else:
+            message = FakeMessage(telegram, chat, text=f"Вопрос {n} из чата {index}: объясни пример кода")
+            handler = bot.handle_text
+
+        update = SimpleNamespace(message=message, effective_user=update_user, effective_chat=chat)
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+            outcome = "error_answer" if chat.last_text.startswith(ERROR_PREFIXES) else "ok"
+        except Exception as e:
+            outcome = type(e).__name__
+        recorder.add(time.perf_counter() - started, outcome)
+        files.pop(f"file-{index}-{n}", None)
+
+        if args.think:
+            await asyncio.sleep(rng.expovariate(1 / args.think))
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+
+    proxy_config = stub_proxy.parse_args(shlex.split(args.proxy))
+    proxy_port = free_port()
+    proxy = await start_app(stub_proxy.create_app(proxy_config), proxy_port)
+
+    files = {}
+
+    async def serve_file(request: web.Request) -> web.Response:
+        data = files.get(request.match_info["name"])
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data)
+
+    files_app = web.Application()
+    files_app.router.add_get("/files/{name}", serve_file)
+    files_port = free_port()
+    files_runner = await start_app(files_app, files_port)
+
+    # Настройки бота читаются при импорте, поэтому окружение готовится до него
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": "bench",
+        "GAS_PROXY_URL": f"http://127.0.0.1:{proxy_port}/",
+        "BOT_MODE": "polling",
+        "METRICS_PORT": "0",
+    })
+    os.environ.setdefault("GEMINI_CACHE", "off")  # одинаковые вопросы не должны попадать в кеш
+    os.environ.setdefault("BOT_HISTORY_DB", os.path.join(workdir, "history.sqlite3"))
+    sys.path.insert(0, os.path.join(ROOT, "bot"))
+    import bot
+
+    telegram = FakeTelegram(args.telegram_delay, f"http://127.0.0.1:{files_port}/files")
+    application = SimpleNamespace(bot=telegram.bot)
+    await bot.post_init(application)
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            run_chat(bot, telegram, index, args, files, random.Random(rng.random()), recorder)
+            for index in range(args.chats)
+        ))
+    finally:
+        elapsed = time.perf_counter() - started
+        await bot.post_shutdown(application)
+        await files_runner.cleanup()
+        await proxy.cleanup()
+
+    print_report("бот: обработка сообщения целиком", recorder, elapsed, {"бенчмарк вместе с ботом": peak_rss_mb()})
+    print_stages()
+    print("вызовы Bot API: " + ", ".join(f"{name} {count}" for name, count in telegram.calls.most_common()))
+    print("заглушка прокси: " + ", ".join(f"{name} {value}" for name, value in proxy.app["stats"].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument("--chats", type=int, default=20, help="одновременных чатов")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого чата")
+    parser.add_argument("--files", type=float, default=0.2, help="доля сообщений с файлом")
+    parser.add_argument("--file-mime", default="text/plain", help="тип файлов (text/plain, image/jpeg, ...)")
+    parser.add_argument("--file-size", type=int, default=200 * 1024, help="размер файла, байт")
+    parser.add_argument("--same-file", action="store_true", help="все файлы — один и тот же (проверка кеша)")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза между сообщениями чата, с")
+    parser.add_argument("--telegram-delay", type=float, default=0.03, help="задержка вызова Bot API, с")
+    parser.add_argument("--proxy", default="--delay 0.5 --chunk-words 5",
+                        help="аргументы заглушки прокси (см. python -m shared.stub_proxy --help)")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import socket
+import resource
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# Общее для нагрузочных бенчмарков: запуск заглушек, сбор задержек и отчёт.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_app(app: web.Application, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) по уже отсортированным значениям, с интерполяцией."""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    """Пиковый RSS процесса в МБ: своего — по getrusage, чужого — по VmHWM из /proc (только Linux)."""
+    if pid is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В Linux ru_maxrss в килобайтах, в macOS — в байтах
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Recorder:
+    """Задержки успешных запросов и число исходов по видам (ok, 500, timeout...)."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.outcomes = Counter()
+
+    def add(self, seconds: float, outcome: str = "ok"):
+        self.outcomes[outcome] += 1
+        if outcome == "ok":
+            self.latencies.append(seconds)
+
+    def summary(self, elapsed: float) -> Dict[str, float]:
+        values = sorted(self.latencies)
+        total = sum(self.outcomes.values())
+        return {
+            "requests": total,
+            "throughput": total / elapsed if elapsed > 0 else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0,
+        }
+
+
+def print_report(title: str, recorder: Recorder, elapsed: float, rss: Optional[Dict[str, Optional[float]]] = None):
+    summary = recorder.summary(elapsed)
+    print(f"\n=== {title} ===")
+    print(f"запросов: {summary['requests']} за {elapsed:.1f} с, {summary['throughput']:.1f} в секунду")
+    print(f"задержка, с: p50 {summary['p50']:.3f}  p95 {summary['p95']:.3f}  "
+          f"p99 {summary['p99']:.3f}  max {summary['max']:.3f}")
+    print("исходы: " + ", ".join(f"{name} {count}" for name, count in recorder.outcomes.most_common()))
+    for name, value in (rss or {}).items():
+        if value is not None:
+            print(f"пиковый RSS ({name}): {value:.1f} МБ")
+
+
+def print_stages():
+    """Среднее время этапов из метрик процесса (shared.metrics), если бенчмарк гонял код в себе."""
+    from shared.metrics import STAGE_SECONDS
+
+    totals = sorted(STAGE_SECONDS.totals().items(), key=lambda item: -item[1][1])
+    if not totals:
+        return
+    print("этапы (число, среднее, с):")
+    for (stage,), (count, total) in totals:
+        print(f"  {stage:<14} {count:>6}  {total / count:.4f}")
@@ -0,0 +1,71 @@
+import os
+import re
+import sys
+import random
+import argparse
+import timeit
+
+# Сравнение прежнего escape_markdown_v2 с однопроходным рендером на длинных ответах модели.
+#
+#   python bench/markdown_bench.py --size 20000 --blocks 40
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot"))
+from markdown_v2 import render_markdown_v2  # noqa: E402
+
+WORDS = ["функция", "значение", "список", "(пример)", "см.", "a_b", "x+1", "[ссылка]", "итог!", "-", "*важно*"]
+CODE = ["def f(x):", "    return x * 2  # `удвоение`", "print(f'\\n{f(2)}')", "items = [i for i in range(10)]"]
+
+
+def legacy_escape_markdown_v2(text: str) -> str:
+    """Прежняя реализация из bot.py: три прохода и замена плейсхолдеров по одному."""
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    code_blocks = re.findall(r"```.*?```", text, re.DOTALL)
+    placeholder = "___CODE_BLOCK___"
+
+    text_processed = re.sub(r"```.*?```", placeholder, text, flags=re.DOTALL)
+    text_escaped = re.sub(f"([{re.escape(escape_chars)}])", r'\\\1', text_processed)
+
+    for block in code_blocks:
+        text_escaped = text_escaped.replace(placeholder, block, 1)
+
+    return text_escaped
+
+
+def make_answer(size: int, blocks: int, seed: int = 0) -> str:
+    """Ответ похожий на модельный: абзацы текста вперемешку с блоками и `встроенным` кодом."""
+    rng = random.Random(seed)
+    parts = []
+    per_block = max(size // (blocks + 1), 1)
+    for n in range(blocks + 1):
+        paragraph = []
+        while sum(map(len, paragraph)) < per_block:
+            word = rng.choice(WORDS)
+            paragraph.append(f"`{word}`" if rng.random() < 0.05 else word)
+            if rng.random() < 0.08:
+                paragraph.append("\n\n")
+        parts.append(" ".join(paragraph))
+        if n < blocks:
+            lines = [rng.choice(CODE) for _ in range(rng.randint(3, 30))]
+            parts.append("```python\n" + "\n".join(lines) + "\n```")
+    return "\n\n".join(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера MarkdownV2")
+    parser.add_argument("--size", type=int, default=20000, help="длина текста вне кода, символов")
+    parser.add_argument("--blocks", type=int, default=40, help="число блоков кода")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    answer = make_answer(args.size, args.blocks)
+    messages = render_markdown_v2(answer)
+    print(f"ответ: {len(answer)} символов, сообщений MarkdownV2: {len(messages)}, "
+          f"самое длинное: {max(map(len, messages))}")
+
+    for name, fn in (("legacy", legacy_escape_markdown_v2), ("render", render_markdown_v2)):
+        seconds = min(timeit.repeat(lambda: fn(answer), number=args.repeat, repeat=3)) / args.repeat
+        print(f"{name:>8}: {seconds * 1e3:.3f} мс на ответ")
+
+
+if __name__ == "__main__":
+    main()
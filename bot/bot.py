@@ -1,12 +1,13 @@
 import os
+import sys
+import time
 import asyncio
-import base64
-import re
+from contextlib import AsyncExitStack
+from typing import List, Optional, Tuple
 from telegram import BotCommandScopeAllPrivateChats, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from io import BytesIO
 from dotenv import load_dotenv
 
-import aiohttp
 import requests
 from telegram import Update, BotCommand
 from telegram.ext import (
@@ -14,14 +15,37 @@ from telegram.ext import (
     MessageHandler, ContextTypes, filters
 )
 
+# === Настройки окружения ===
+# До чтения констант: значения из .env должны действовать и на них
+load_dotenv()
+
 # === КОНСТАНТЫ ===
-MAX_HISTORY_MESSAGES = 4
-MAX_RETRIES = 3
+# Сколько реплик хранить; в запрос идёт столько последних, сколько влезает в HISTORY_MAX_TOKENS
+MAX_HISTORY_MESSAGES = int(os.getenv("BOT_HISTORY_MAX_MESSAGES", "40"))
+STREAM_EDIT_INTERVAL = 1.5  # секунд между правками сообщения во время потокового ответа
+MAX_FILE_SIZE = 20 * 1024 * 1024  # лимит getFile в Bot API
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://neon-fox-1a64b2.netlify.app/")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
 # ===============================
 
-# === Настройки окружения ===
-load_dotenv()
+# Общий код бота и API-сервера лежит в shared/ в корне репозитория
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.admission import QueueFullError  # noqa: E402
+from shared.cache import create_cache  # noqa: E402
+from shared.documents import analyze_chunks, split_document, worth_splitting  # noqa: E402
+from shared.gemini_client import GeminiClient  # noqa: E402
+from shared.history_budget import HistoryManager  # noqa: E402
+from shared.http_session import get_session, close_session  # noqa: E402
+from shared.image_prep import can_resize, pick_photo_size, prepare_image  # noqa: E402
+from shared.inline_file import InlineFile, download_bytes, download_inline_file  # noqa: E402
+from shared.metrics import REGISTRY, stage, start_metrics_server, track  # noqa: E402
+from shared.offload import OFFLOAD_MIN_CHARS, loop_monitor, run_cpu, shutdown as shutdown_offload  # noqa: E402
+from history_store import ChatHistoryStore  # noqa: E402
+from markdown_v2 import TELEGRAM_MESSAGE_LIMIT, render_markdown_v2, split_plain, unescape_markdown_v2  # noqa: E402
+from media_cache import MediaCache  # noqa: E402
+from media_group import MediaGroupCollector  # noqa: E402
+from outbox import TelegramOutbox  # noqa: E402
+from webhook import run_webhook  # noqa: E402
 
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 GAS_PROXY_URL = os.getenv("GAS_PROXY_URL")
@@ -34,119 +58,168 @@ if not TOKEN or not GAS_PROXY_URL:
     exit(1)
 
 
-# === УТИЛИТА: ЭКРАНИРОВАНИЕ MARKDOWNV2 ===
-def escape_markdown_v2(text: str) -> str:
-    """Экранирует специальные символы MarkdownV2, кроме тех, что внутри блоков кода."""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    code_blocks = re.findall(r"```.*?```", text, re.DOTALL)
-    placeholder = "___CODE_BLOCK___"
+# === Gemini-прокси ===
+# Кеш подключается в post_init: в режиме webhook это происходит уже в процессе воркера,
+# а соединение sqlite нельзя унаследовать через fork
+gemini_client = GeminiClient(GAS_PROXY_URL)
 
-    text_processed = re.sub(r"```.*?```", placeholder, text, flags=re.DOTALL)
-    text_escaped = re.sub(f"([{re.escape(escape_chars)}])", r'\\\1', text_processed)
+# История диалогов: активные чаты в памяти, отложенная запись в sqlite
+history_store = ChatHistoryStore(MAX_HISTORY_MESSAGES)
 
-    for block in code_blocks:
-        text_escaped = text_escaped.replace(placeholder, block, 1)
+# Какая часть истории уходит в запрос: по бюджету токенов, начало — сводкой
+history_manager = HistoryManager(gemini_client)
 
-    return text_escaped
+# Закодированные файлы по file_unique_id: пересланное повторно не скачивается
+media_cache = MediaCache()
 
+# Части альбома, которые Telegram присылает отдельными сообщениями
+media_groups = MediaGroupCollector()
 
-# === Gemini-прокси ===
-async def query_gemini(prompt: str, file_data: str = None, mime_type: str = None, history: list = None) -> str:
-    """Отправляет запрос к Gemini через прокси."""
-    system_instruction_text = (
-        "Отвечай всегда на русском языке, если вопрос не содержит другого указания. "
-        "Если есть прикрепленный файл, внимательно его проанализируй. "
-        "Если ответ содержит программный код, **обязательно форматируй его в блок с подсветкой синтаксиса** "
-        "(например, ```python\\nваш_код\\n```). "
-        "**Перед блоком кода** добавь краткое вводное предложение."
-    )
+# Исходящие вызовы Telegram: лимиты на чат и на процесс, склейка правок, повтор после 429
+outbox = TelegramOutbox()
+
+# Метрики: этапы обработки пишутся через stage(), состояние клиента и очереди снимается при запросе /metrics
+gemini_client.export_metrics()
+outbox.export_metrics()
+MARKDOWN_FALLBACKS = REGISTRY.counter(
+    "telegram_markdown_fallbacks_total", "Частей ответа, повторно отправленных без разметки", ("where",)
+)
+metrics_runner = None
 
-    contents = history if history else []
 
-    if not history:
-        contents.append({
-            "role": "user",
-            "parts": [{"text": system_instruction_text}]
-        })
+def _history_key(update: Update) -> str:
+    """История ведётся отдельно для каждого пользователя в каждом чате."""
+    return f"{update.effective_user.id}:{update.message.chat_id}"
 
-    current_user_parts = []
 
-    if file_data and mime_type:
-        current_user_parts.append({
-            "inlineData": {
-                "mimeType": mime_type,
-                "data": file_data
-            }
-        })
+async def query_gemini(prompt: str, file_data: str = None, mime_type: str = None, history: list = None,
+                       user_key: str = None, files: list = None) -> str:
+    """Отправляет запрос к Gemini через общий клиент прокси."""
+    return await gemini_client.query_gemini(prompt, file_data, mime_type, history, user_key=user_key, files=files)
 
-    current_user_parts.append({"text": prompt})
 
-    contents.append({
-        "role": "user",
-        "parts": current_user_parts
-    })
+async def stream_gemini_to_message(status_message, prompt: str, history: list = None, user_key: str = None) -> str:
+    """Получает ответ потоком и показывает его в статусном сообщении по мере генерации.
 
-    payload = {
-        "model": "gemini-2.5-flash",
-        "args": {
-            "contents": contents
-        }
-    }
+    Правки идут не чаще раза в STREAM_EDIT_INTERVAL секунд и не ждут отправки:
+    если предыдущая ещё в очереди outbox, новая её заменяет. Возвращает полный текст ответа.
+    """
+    chunks = []
+    last_edit = time.monotonic()
+    shown = ""
+
+    async for delta in gemini_client.stream_gemini(prompt, history=history, user_key=user_key):
+        chunks.append(delta)
+
+        if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+
+        preview = "".join(chunks)[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+        if preview == shown:
+            continue
+        await outbox.edit_text(status_message, preview, wait=False)
+        shown = preview
+        last_edit = time.monotonic()
+
+    return "".join(chunks)
+
+
+async def send_answer(message, status_message, answer: str):
+    """Показывает ответ в статусном сообщении, продолжение — ответами на сообщение пользователя.
+
+    Ответ размечается и режется на части заранее, поэтому каждая укладывается
+    в лимит Telegram, а блоки кода не разрываются. Если Telegram всё же отверг
+    разметку, эта часть отправляется простым текстом, без повторной попытки.
+    Длинный ответ размечается вне event loop.
+    """
+    if not answer.strip():
+        # Пустой текст Telegram не примет ни с разметкой, ни без неё
+        answer = "Нет текста в ответе."
+    with stage("render"):
+        parts = await run_cpu(render_markdown_v2, answer, size=len(answer), threshold=OFFLOAD_MIN_CHARS)
+    try:
+        await outbox.edit_text(status_message, parts[0], parse_mode='MarkdownV2')
+    except Exception as e:
+        print(f"Ошибка при edit_text (MarkdownV2): {e}")
+        MARKDOWN_FALLBACKS.inc(where="edit")
+        # Разметка не прошла — весь ответ отправляем без неё
+        parts = split_plain(answer)
+        await outbox.edit_text(status_message, parts[0])
+        for part in parts[1:]:
+            await outbox.reply_text(message, part)
+        return
 
-    for attempt in range(MAX_RETRIES):
+    for part in parts[1:]:
         try:
-            async with aiohttp.ClientSession() as s:
-                async with s.post(GAS_PROXY_URL, json=payload, timeout=60) as r:
-                    if r.status >= 500:
-                        if attempt < MAX_RETRIES - 1:
-                            await asyncio.sleep(1)
-                            continue
-                        else:
-                            r.raise_for_status()
-
-                    r.raise_for_status()
-                    data = await r.json()
-
-                    text = (
-                        data.get("candidates", [{}])[0]
-                        .get("content", {})
-                        .get("parts", [{}])[0]
-                        .get("text", "")
-                    )
-                    return text or data.get("error", "Нет текста в ответе.")
-
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            if attempt < MAX_RETRIES - 1:
-                await asyncio.sleep(1)
-                continue
-            else:
-                return f"Ошибка сетевого запроса к прокси после {MAX_RETRIES} попыток: {e}"
+            await outbox.reply_text(message, part, parse_mode='MarkdownV2')
         except Exception as e:
-            return f"Общая ошибка при запросе к Gemini: {e}"
+            print(f"Ошибка при reply_text (MarkdownV2): {e}")
+            MARKDOWN_FALLBACKS.inc(where="reply")
+            await outbox.reply_text(message, unescape_markdown_v2(part))
+
 
-    return "Не удалось получить ответ от модели после всех повторных попыток."
+# === Утилиты для загрузки файла ===
+async def _get_download_url(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> str:
+    file_obj = await context.bot.get_file(file_id)
+    download_url = file_obj.file_path
 
+    if not download_url:
+        raise ValueError("Не удалось получить URL для скачивания файла.")
+    return download_url
 
-# === Утилита для загрузки файла ===
-async def _download_file_as_base64(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> str:
-    """Загружает файл из Telegram и возвращает его содержимое в Base64."""
+
+async def _download_file_bytes(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> bytes:
+    """Загружает файл из Telegram целиком в память (для разбора документа)."""
     try:
-        file_obj = await context.bot.get_file(file_id)
-        download_url = file_obj.file_path
+        with stage("download"):
+            download_url = await _get_download_url(context, file_id)
+            return await download_bytes(await get_session(), download_url, max_size=MAX_FILE_SIZE)
+    except Exception as e:
+        raise Exception(f"Ошибка при загрузке файла: {e}")
 
-        if not download_url:
-            raise ValueError("Не удалось получить URL для скачивания файла.")
 
-        async with aiohttp.ClientSession() as s:
-            async with s.get(download_url) as r:
-                r.raise_for_status()
-                file_bytes = await r.read()
+async def _download_file_as_base64(context: ContextTypes.DEFAULT_TYPE, file_id: str, mime_type: str,
+                                   data: Optional[bytes] = None) -> InlineFile:
+    """Загружает файл из Telegram потоком, кодируя в Base64 по частям.
 
-        return base64.b64encode(file_bytes).decode('utf-8')
+    Большие файлы уходят во временный файл на диске, а не копятся в памяти.
+    Картинки сверх IMAGE_MAX_PIXELS скачиваются целиком и уменьшаются.
+    data — уже скачанное содержимое, тогда файл только кодируется.
+    Файлом дальше владеет кеш media_cache.
+    """
+    try:
+        if data is None:
+            # Потоковая загрузка кодирует на лету, так что download включает и base64
+            with stage("download"):
+                download_url = await _get_download_url(context, file_id)
+                session = await get_session()
+                if not can_resize(mime_type):
+                    return await download_inline_file(session, download_url, mime_type, max_size=MAX_FILE_SIZE)
+                data = await download_bytes(session, download_url, max_size=MAX_FILE_SIZE)
+        with stage("image_prep"):
+            data = await prepare_image(data, mime_type)
+        with stage("encode"):
+            return await InlineFile.from_bytes_async(mime_type, data)
     except Exception as e:
         raise Exception(f"Ошибка при загрузке или кодировании файла: {e}")
 
 
+async def _analyze_document(status_message, prompt: str, chunks: List[str], user_key: str) -> str:
+    """Разбирает большой документ по частям, показывая прогресс в статусном сообщении."""
+    last_edit = 0.0
+
+    async def progress(done: int, total: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        # Прогресс не важнее самого разбора — не ждём отправки
+        await outbox.edit_text(status_message, f"2️⃣ Документ большой, разбираю по частям: {done} из {total}...",
+                               wait=False)
+
+    return await analyze_chunks(gemini_client, prompt, chunks, user_key=user_key, progress=progress)
+
+
 # === КОМАНДЫ БОТА ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправляет приветственное сообщение."""
@@ -180,9 +253,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Очищает историю диалога для текущего чата."""
-    chat_id = update.message.chat_id
-    if 'history' in context.user_data and chat_id in context.user_data['history']:
-        context.user_data['history'][chat_id] = []
+    key = _history_key(update)
+    history_manager.reset(key)
+    if await history_store.get(key):
+        await history_store.reset(key)
         await update.message.reply_text("✅ История диалога была очищена. Начните новый разговор.")
     else:
         await update.message.reply_text("⚠️ История диалога уже пуста.")
@@ -210,13 +284,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
 
-    chat_id = update.message.chat_id
-
-    if 'history' not in context.user_data:
-        context.user_data['history'] = {}
-
-    chat_history = context.user_data['history'].get(chat_id, [])
-
     bot_username = (await context.bot.get_me()).username.lower()
     text = update.message.text
 
@@ -228,45 +295,76 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not text:
         if update.message.chat.type in ("group", "supergroup"):
-            await update.message.reply_text(
-                "💬 Задайте свой вопрос сразу после упоминания меня!"
+            await outbox.reply_text(
+                update.message, "💬 Задайте свой вопрос сразу после упоминания меня!"
             )
         return
 
-    await update.message.chat.send_action(action="TYPING")
-    status_message = await update.message.reply_text("⌛ Думаю...")
-
-    # Используем query_gemini с историей
-    answer = await query_gemini(text, history=chat_history)
+    with track("text") as tracked:
+        outbox.send_action(update.message)
+        status_message = await outbox.reply_text(update.message, "⌛ Думаю...")
 
-    # Обновляем историю
-    chat_history.append({
-        "role": "user",
-        "parts": [{"text": text}]
-    })
-    chat_history.append({
-        "role": "model",
-        "parts": [{"text": answer}]
-    })
-
-    # Обрезаем историю
-    chat_history = chat_history[-(MAX_HISTORY_MESSAGES):]
-    context.user_data['history'][chat_id] = chat_history
+        # Получаем ответ потоком с историей
+        history_key = _history_key(update)
+        chat_history = await history_manager.prepare(history_key, await history_store.get(history_key), text)
+        try:
+            answer = await stream_gemini_to_message(
+                status_message, text, history=chat_history, user_key=str(update.message.chat_id)
+            )
+        except QueueFullError as e:
+            tracked.fail()
+            await outbox.edit_text(status_message, f"⏳ {e}")
+            return
 
-    # Отправляем ответ
-    escaped_answer = escape_markdown_v2(answer)
+        # Обновляем историю (хранилище держит последние MAX_HISTORY_MESSAGES реплик)
+        await history_store.append(
+            history_key,
+            {"role": "user", "parts": [{"text": text}]},
+            {"role": "model", "parts": [{"text": answer}]},
+        )
 
-    try:
-        await status_message.edit_text(escaped_answer, parse_mode='MarkdownV2')
-    except Exception as e:
-        print(f"Ошибка при edit_text (MarkdownV2): {e}")
-        for chunk in [escaped_answer[i:i + 4000] for i in range(0, len(escaped_answer), 4000)]:
-            try:
-                await update.message.reply_text(chunk, parse_mode='MarkdownV2')
-            except Exception as e_reply:
-                print(f"Критическая ошибка при reply_text (MarkdownV2): {e_reply}")
-                await update.message.reply_text(
-                    "❌ Извините, произошла ошибка форматирования. Вот текст без форматирования:\n\n" + answer)
+        # Отправляем ответ
+        await send_answer(update.message, status_message, answer)
+
+
+def _message_file(message) -> Optional[Tuple[str, str, str, Optional[int]]]:
+    """Файл сообщения: (file_id, file_unique_id, mime_type, размер) или None."""
+    if message.photo:
+        # Не самый крупный вариант, а достаточный для модели (IMAGE_MAX_PIXELS)
+        photo = pick_photo_size(message.photo)
+        return photo.file_id, photo.file_unique_id, "image/jpeg", photo.file_size
+    if message.document:
+        document = message.document
+        return document.file_id, document.file_unique_id, document.mime_type, document.file_size
+    return None
+
+
+async def _update_status(status_message, text: str):
+    # Повторное «печатает...» сразу после первого outbox отбросит
+    outbox.send_action(status_message)
+    await outbox.edit_text(status_message, text)
+
+
+async def _query_album(context: ContextTypes.DEFAULT_TYPE, status_message, prompt: str,
+                       files: list, user_key: str) -> str:
+    """Один запрос по всем файлам альбома; файлы скачиваются параллельно."""
+    async with AsyncExitStack() as stack:
+        leased = await asyncio.gather(
+            *(stack.enter_async_context(media_cache.lease(
+                file_unique_id,
+                lambda file_id=file_id, mime_type=mime_type: _download_file_as_base64(context, file_id, mime_type),
+            )) for file_id, file_unique_id, mime_type, _ in files),
+            return_exceptions=True,
+        )
+        for result in leased:
+            if isinstance(result, BaseException):
+                raise result
+
+        await _update_status(status_message, "2️⃣ Анализирую альбом с помощью Gemini...")
+        return await query_gemini(
+            prompt, history=[], user_key=user_key,
+            files=[(inline_file, mime_type) for inline_file, (_, _, mime_type, _) in zip(leased, files)],
+        )
 
 
 async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -274,72 +372,105 @@ async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
 
-    is_group = update.message.chat.type in ("group", "supergroup")
+    messages = [update.message]
+    if update.message.media_group_id:
+        # Альбом приходит отдельными сообщениями — собираем его и отвечаем один раз
+        messages = await media_groups.collect(update.message.media_group_id, update.message)
+        if messages is None:
+            return
+    message = messages[0]
+
+    is_group = message.chat.type in ("group", "supergroup")
     bot_username = (await context.bot.get_me()).username
-    user_prompt = update.message.caption or update.message.text
+    # Подпись альбома обычно только у одного из сообщений
+    user_prompt = next((m.caption for m in messages if m.caption), None) or message.text
 
     if is_group:
         if not user_prompt or f"@{bot_username}" not in user_prompt:
             return
         user_prompt = user_prompt.replace(f"@{bot_username}", "").strip()
 
-    file_id = None
-    mime_type = None
-
-    # Определяем файл
-    if update.message.photo:
-        largest_photo = update.message.photo[-1]
-        file_id = largest_photo.file_id
-        mime_type = "image/jpeg"
-    elif update.message.document:
-        document = update.message.document
-        supported_mimes = [
-            "image/jpeg",
-            "image/png",
-            "application/pdf",
-            "text/plain",
-        ]
-        if document.mime_type in supported_mimes:
-            file_id = document.file_id
-            mime_type = document.mime_type
-        else:
-            await update.message.reply_text(
-                f"Извините, я не могу обработать файл типа: `{document.mime_type}`. "
-                f"Поддерживаются только изображения, PDF и TXT."
-            )
-            return
-    else:
+    # Определяем файлы
+    supported_mimes = [
+        "image/jpeg",
+        "image/png",
+        "application/pdf",
+        "text/plain",
+    ]
+    files = [f for f in map(_message_file, messages) if f]
+    if not files:
+        return
+    unsupported = [f for f in files if f[2] not in supported_mimes]
+    if unsupported:
+        await outbox.reply_text(
+            message,
+            f"Извините, я не могу обработать файл типа: `{unsupported[0][2]}`. "
+            f"Поддерживаются только изображения, PDF и TXT."
+        )
+        return
+
+    # Размер известен заранее — не начинаем заведомо бесполезную загрузку
+    file_size = max(f[3] or 0 for f in files)
+    if file_size > MAX_FILE_SIZE:
+        await outbox.reply_text(
+            message,
+            f"Извините, файл слишком большой ({file_size // (1024 * 1024)} МБ). "
+            f"Максимум — {MAX_FILE_SIZE // (1024 * 1024)} МБ."
+        )
         return
 
     # Получаем текст запроса
     if not user_prompt:
-        user_prompt = "Опиши этот файл и ответь, что на нём изображено, или что в нём содержится."
+        if len(files) > 1:
+            user_prompt = "Опиши эти файлы и ответь, что на них изображено, или что в них содержится."
+        else:
+            user_prompt = "Опиши этот файл и ответь, что на нём изображено, или что в нём содержится."
 
     # Начинаем процесс
-    await update.message.chat.send_action(action="TYPING")
-    status_message = await update.message.reply_text(f"1️⃣ Загружаю и анализирую ваш файл ({mime_type})...")
-
-    try:
-        # Загрузка файла и кодирование в base64
-        base64_data = await _download_file_as_base64(context, file_id)
-
-        # Анализ Gemini
-        await update.message.chat.send_action(action="TYPING")
-        await status_message.edit_text("2️⃣ Анализирую файл с помощью Gemini...")
-
-        answer = await query_gemini(user_prompt, base64_data, mime_type, history=[])
-
-        # Ответ
-        escaped_answer = escape_markdown_v2(answer)
-        await status_message.edit_text(escaped_answer, parse_mode='MarkdownV2')
+    with track("files") as tracked:
+        outbox.send_action(message)
+        if len(files) > 1:
+            status_message = await outbox.reply_text(message, f"1️⃣ Загружаю и анализирую альбом ({len(files)} файлов)...")
+        else:
+            status_message = await outbox.reply_text(message, f"1️⃣ Загружаю и анализирую ваш файл ({files[0][2]})...")
 
-    except Exception as e:
-        error_msg = f"❌ Произошла ошибка при обработке файла. Подробнее: {str(e)}"
-        print(f"File handling error: {e}")
+        user_key = str(message.chat_id)
         try:
-            await status_message.edit_text(error_msg)
-        except Exception:
-            await update.message.reply_text(error_msg)
+            if len(files) > 1:
+                answer = await _query_album(context, status_message, user_prompt, files, user_key)
+            else:
+                file_id, file_unique_id, mime_type, file_size = files[0]
+
+                # Большой текст или PDF целиком в один запрос не влезает — разбираем по частям
+                data = chunks = None
+                if worth_splitting(mime_type, file_size):
+                    data = await _download_file_bytes(context, file_id)
+                    with stage("split"):
+                        chunks = await split_document(data, mime_type)
+
+                if chunks:
+                    answer = await _analyze_document(status_message, user_prompt, chunks, user_key)
+                else:
+                    # Загрузка файла и кодирование в base64 (повторно пересланный файл берётся из кеша)
+                    async with media_cache.lease(
+                        file_unique_id, lambda: _download_file_as_base64(context, file_id, mime_type, data)
+                    ) as inline_file:
+                        # Анализ Gemini
+                        await _update_status(status_message, "2️⃣ Анализирую файл с помощью Gemini...")
+
+                        answer = await query_gemini(user_prompt, inline_file, mime_type, history=[], user_key=user_key)
+
+            # Ответ
+            await send_answer(message, status_message, answer)
+
+        except Exception as e:
+            error_msg = f"❌ Произошла ошибка при обработке файла. Подробнее: {str(e)}"
+            print(f"File handling error: {e}")
+            tracked.fail()
+            try:
+                await outbox.edit_text(status_message, error_msg)
+            except Exception:
+                await outbox.reply_text(message, error_msg)
 
 
 # === УСТАНОВКА КОМАНД ===
@@ -358,10 +489,45 @@ async def set_bot_commands(app):
     )
 
 
+async def post_init(app):
+    """Готовит общую HTTP-сессию, хранилище истории и команды бота при старте."""
+    global metrics_runner
+    if gemini_client.cache is None:
+        gemini_client.cache = create_cache()
+    await get_session()
+    loop_monitor.start()
+    await history_store.start()
+    await media_cache.start()
+    await set_bot_commands(app)
+    # В режиме webhook /metrics отдаёт сам воркер
+    if BOT_MODE != "webhook":
+        metrics_runner = await start_metrics_server()
+
+
+async def post_shutdown(app):
+    """Сохраняет историю и закрывает общую HTTP-сессию при остановке бота."""
+    await outbox.join()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await history_store.stop()
+    await media_cache.stop()
+    await close_session()
+    await loop_monitor.stop()
+    shutdown_offload()
+
+
 # === ЗАПУСК ===
-def main():
-    """Основная функция запуска бота."""
-    app = ApplicationBuilder().token(TOKEN).concurrent_updates(True).read_timeout(30).build()
+def build_application():
+    """Собирает приложение бота с обработчиками (в режиме webhook — в каждом воркере)."""
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .read_timeout(30)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # === Регистрация обработчиков ===
     app.add_handler(CommandHandler("start", start))
@@ -378,11 +544,18 @@ def main():
 
     # Обработчик для текстовых сообщений
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    return app
 
-    app.post_init = set_bot_commands
+
+def main():
+    """Основная функция запуска бота."""
+    if BOT_MODE == "webhook":
+        # Обновления принимает HTTP-эндпоинт, чаты распределены между воркерами
+        run_webhook(build_application)
+        return
 
     print("✅ Бот запущен. Работает в чатах и группах.")
-    app.run_polling()
+    build_application().run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+import os
+import time
+import json
+import asyncio
+import sqlite3
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+# === НАСТРОЙКИ ХРАНЕНИЯ ИСТОРИИ БОТА ===
+HISTORY_DB_PATH = os.getenv("BOT_HISTORY_DB", "bot_history.sqlite3")
+HISTORY_FLUSH_INTERVAL = float(os.getenv("BOT_HISTORY_FLUSH_INTERVAL", "5"))
+HISTORY_IDLE_TTL = float(os.getenv("BOT_HISTORY_IDLE_TTL", "1800"))
+# ===============================
+
+
+class ChatHistoryStore:
+    """История диалогов бота с отложенной записью в sqlite.
+
+    Активные чаты держатся в памяти в компактном виде — deque пар (role, text)
+    вместо вложенных словарей Gemini. Изменения копятся и пишутся в базу
+    одной транзакцией раз в flush_interval секунд. Чаты, к которым не
+    обращались idle_ttl секунд, выгружаются из памяти и подгружаются
+    из базы при следующем сообщении.
+    """
+
+    def __init__(self, max_messages: int, path: str = HISTORY_DB_PATH,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL, idle_ttl: float = HISTORY_IDLE_TTL):
+        self.max_messages = max_messages
+        self.path = path
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self._chats = OrderedDict()  # key -> [deque пар (role, text), время последнего обращения]
+        self._dirty = set()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    # === Жизненный цикл ===
+    async def start(self):
+        """Открывает базу и запускает фоновую запись (из post_init бота)."""
+        self._conn = await asyncio.to_thread(self._connect)
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает несохранённые изменения."""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_history ("
+            "key TEXT PRIMARY KEY, turns TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        return conn
+
+    # === Доступ к истории ===
+    async def _load(self, key: str) -> list:
+        item = self._chats.get(key)
+        if item is None:
+            turns = await self._read(key)
+            # Пока читали базу, чат мог загрузиться параллельным обработчиком
+            item = self._chats.get(key) or [deque(turns, maxlen=self.max_messages), 0.0]
+            self._chats[key] = item
+        item[1] = time.monotonic()
+        self._chats.move_to_end(key)
+        return item
+
+    async def get(self, key: str) -> List[Dict]:
+        """Возвращает историю в формате contents Gemini."""
+        turns, _ = await self._load(key)
+        return [{"role": role, "parts": [{"text": text}]} for role, text in turns]
+
+    async def append(self, key: str, *messages: Dict):
+        turns, _ = await self._load(key)
+        for message in messages:
+            text = "".join(part.get("text", "") for part in message["parts"])
+            turns.append((message["role"], text))
+        self._dirty.add(key)
+
+    async def reset(self, key: str):
+        turns, _ = await self._load(key)
+        turns.clear()
+        self._dirty.add(key)
+
+    # === Запись в базу ===
+    async def _read(self, key: str) -> list:
+        if self._conn is None:
+            return []
+        async with self._db_lock:
+            row = await asyncio.to_thread(
+                lambda: self._conn.execute("SELECT turns FROM chat_history WHERE key = ?", (key,)).fetchone()
+            )
+        return [tuple(turn) for turn in json.loads(row[0])] if row else []
+
+    def _write(self, upserts: list, deletes: list):
+        now = time.time()
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chat_history (key, turns, updated) VALUES (?, ?, ?)",
+                [(key, turns, now) for key, turns in upserts],
+            )
+            self._conn.executemany("DELETE FROM chat_history WHERE key = ?", [(key,) for key in deletes])
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def flush(self):
+        """Пишет все накопленные изменения одной транзакцией."""
+        if self._conn is None or not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in dirty:
+            item = self._chats.get(key)
+            if item is None:
+                continue
+            if item[0]:
+                upserts.append((key, json.dumps(list(item[0]), ensure_ascii=False)))
+            else:
+                deletes.append(key)
+
+        try:
+            async with self._db_lock:
+                await asyncio.to_thread(self._write, upserts, deletes)
+        except Exception as e:
+            print(f"Ошибка записи истории в базу: {e}")
+            self._dirty |= dirty
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._chats:
+            key, (_, last_seen) = next(iter(self._chats.items()))
+            if last_seen > cutoff or key in self._dirty:
+                break
+            del self._chats[key]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict_idle()
@@ -0,0 +1,152 @@
+import re
+from typing import List
+
+# Рендер ответа модели в MarkdownV2 Telegram за один проход.
+#
+# Текст разбирается одним заранее скомпилированным выражением на три вида
+# фрагментов: блоки кода ```lang ... ```, встроенный код `...` и обычный текст.
+# В тексте экранируются все спецсимволы MarkdownV2, внутри кода — только ` и \,
+# как требует Bot API. Результат сразу режется на сообщения не длиннее лимита
+# по границам строк и слов, так что экранирование и блоки кода не разрываются:
+# разрезанный блок кода закрывается в одном сообщении и открывается в следующем.
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+_TOKEN_RE = re.compile(
+    r"```(?:(?P<lang>[\w+#.-]+)?[ \t]*\n)?(?P<pre>.*?)(?:```|\Z)"  # блок кода (незакрытый — до конца текста)
+    r"|`(?P<code>[^`\n]+)`",                                       # встроенный код
+    re.DOTALL,
+)
+_TEXT_TABLE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+_CODE_TABLE = str.maketrans({"\\": "\\\\", "`": "\\`"})
+_BREAK_RE = re.compile(r"[^\n]*\n|[^\n]+")  # строки с переводом строки на конце
+_WORD_RE = re.compile(r"\S*\s*")
+_UNESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+
+
+def escape_text(text: str) -> str:
+    return text.translate(_TEXT_TABLE)
+
+
+def escape_code(text: str) -> str:
+    return text.translate(_CODE_TABLE)
+
+
+def unescape_markdown_v2(text: str) -> str:
+    """Готовое сообщение MarkdownV2 как простой текст (на случай, если Telegram отверг разметку)."""
+    return _UNESCAPE_RE.sub(r"\1", text)
+
+
+def _pieces(raw: str, escape, budget: int):
+    """Режет raw на куски, каждый из которых после экранирования не длиннее budget.
+
+    Сначала по строкам, длинные строки — по словам, совсем длинные слова — по символам.
+    Режется исходный текст, поэтому обратная косая черта не отрывается от символа.
+    """
+    for line in _BREAK_RE.findall(raw):
+        escaped = escape(line)
+        if len(escaped) <= budget:
+            yield escaped
+            continue
+        for word in _WORD_RE.findall(line):
+            if not word:
+                continue
+            escaped = escape(word)
+            if len(escaped) <= budget:
+                yield escaped
+                continue
+            start = size = 0
+            for i, char in enumerate(word):
+                width = len(escape(char))
+                if size + width > budget:
+                    yield escape(word[start:i])
+                    start, size = i, 0
+                size += width
+            yield escape(word[start:])
+
+
+class _Packer:
+    """Складывает готовые фрагменты в сообщения не длиннее limit."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.messages: List[str] = []
+        self._current: List[str] = []
+        self._size = 0
+
+    @property
+    def room(self) -> int:
+        return self.limit - self._size
+
+    def add(self, piece: str):
+        if len(piece) > self.room:
+            self.flush()
+        self._current.append(piece)
+        self._size += len(piece)
+
+    def flush(self):
+        if self._current:
+            self.messages.append("".join(self._current))
+            self._current, self._size = [], 0
+
+    def add_text(self, raw: str, escape=escape_text):
+        escaped = escape(raw)
+        if len(escaped) <= self.room:
+            self.add(escaped)
+            return
+        for piece in _pieces(raw, escape, self.limit):
+            self.add(piece)
+
+    def add_wrapped(self, raw: str, opening: str, closing: str):
+        """Код в обрамлении: если не помещается в одно сообщение, каждая часть обрамляется заново."""
+        escaped = escape_code(raw)
+        whole = f"{opening}{escaped}{closing}"
+        if len(whole) <= self.limit:
+            self.add(whole)
+            return
+
+        budget = self.limit - len(opening) - len(closing)
+        part = []
+        size = 0
+        for piece in _pieces(raw, escape_code, budget):
+            if size + len(piece) > budget:
+                self.add(f"{opening}{''.join(part)}{closing}")
+                part, size = [], 0
+            part.append(piece)
+            size += len(piece)
+        if part:
+            self.add(f"{opening}{''.join(part)}{closing}")
+
+
+def render_markdown_v2(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Превращает ответ модели в сообщения MarkdownV2 не длиннее limit символов."""
+    packer = _Packer(limit)
+    position = 0
+
+    for match in _TOKEN_RE.finditer(text):
+        if match.start() > position:
+            packer.add_text(text[position:match.start()])
+        position = match.end()
+
+        code = match.group("code")
+        if code is not None:
+            packer.add_wrapped(code, "`", "`")
+            continue
+
+        pre = match.group("pre")
+        if not pre.endswith("\n"):
+            pre += "\n"
+        packer.add_wrapped(pre, f"```{match.group('lang') or ''}\n", "```")
+
+    if position < len(text):
+        packer.add_text(text[position:])
+    packer.flush()
+    return packer.messages or [""]
+
+
+def split_plain(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Режет текст без разметки на сообщения по тем же границам строк и слов."""
+    packer = _Packer(limit)
+    packer.add_text(text, escape=str)
+    packer.flush()
+    return packer.messages or [""]
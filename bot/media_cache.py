@@ -0,0 +1,212 @@
+import os
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+from shared.inline_file import InlineFile
+from shared.singleflight import SingleFlight
+
+# === НАСТРОЙКИ КЕША ФАЙЛОВ ===
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_BYTES", str(64 * 1024 * 1024)))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "")  # пусто - без дискового уровня
+MEDIA_CACHE_DISK_BYTES = int(os.getenv("MEDIA_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+# ===============================
+
+
+class _Entry:
+    def __init__(self, inline_file: InlineFile):
+        self.file = inline_file
+        self.refs = 0
+        self.evicted = False
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.file.close()
+
+
+class MediaCache:
+    """Кеш закодированных файлов Telegram по file_unique_id.
+
+    file_unique_id одинаков у одного и того же файла в любом чате, поэтому
+    пересланные картинки и PDF не скачиваются и не кодируются повторно.
+    В памяти держатся InlineFile в пределах max_bytes (LRU по размеру base64).
+    Если задан каталог, файлы дополнительно сохраняются на диск в пределах
+    disk_bytes и переживают перезапуск бота. Одновременные запросы одного
+    файла скачивают его один раз.
+    """
+
+    def __init__(self, max_bytes: int = MEDIA_CACHE_BYTES, directory: str = MEDIA_CACHE_DIR,
+                 disk_bytes: int = MEDIA_CACHE_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # file_unique_id -> _Entry
+        self._disk = OrderedDict()  # имя файла на диске -> размер
+        self._disk_total = 0
+        self._inflight = SingleFlight()
+        self._writers = set()
+
+    # === Жизненный цикл ===
+    async def start(self):
+        """Читает содержимое дискового уровня (из post_init бота)."""
+        if self.directory:
+            await asyncio.to_thread(self._scan_disk)
+
+    async def stop(self):
+        if self._writers:
+            await asyncio.gather(*self._writers, return_exceptions=True)
+        for entry in self._entries.values():
+            if entry.refs == 0:
+                entry.close()
+            else:
+                entry.evicted = True
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries), "bytes": self.bytes, "hits": self.hits,
+            "disk_hits": self.disk_hits, "misses": self.misses,
+            "disk_entries": len(self._disk), "disk_bytes": self._disk_total,
+        }
+
+    # === Доступ ===
+    @asynccontextmanager
+    async def lease(self, unique_id: str, loader: Callable[[], Awaitable[InlineFile]]):
+        """Выдаёт InlineFile на время запроса; loader вызывается только при промахе.
+
+        Файл принадлежит кешу — вызывающий не закрывает его сам.
+        """
+        while True:
+            entry = self._entries.get(unique_id)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(unique_id)
+            else:
+                entry = await self._inflight.do(unique_id, lambda: self._load(unique_id, loader))
+            # Пока ждали загрузку, запись могли вытеснить и закрыть — берём заново
+            if not entry.closed:
+                break
+
+        entry.refs += 1
+        try:
+            yield entry.file
+        finally:
+            entry.refs -= 1
+            if entry.evicted and entry.refs == 0 and not entry.closed:
+                entry.close()
+
+    async def _load(self, unique_id: str, loader) -> _Entry:
+        inline_file = await self._read_disk(unique_id) if self.directory else None
+        if inline_file is not None:
+            self.disk_hits += 1
+            return self._insert(unique_id, inline_file)
+
+        self.misses += 1
+        entry = self._insert(unique_id, await loader())
+        if self.directory and entry.file.encoded_size <= self.disk_bytes:
+            entry.refs += 1  # не закрывать файл, пока он пишется на диск
+            task = asyncio.create_task(self._write_disk(unique_id, entry))
+            self._writers.add(task)
+            task.add_done_callback(self._writers.discard)
+        return entry
+
+    def _insert(self, unique_id: str, inline_file: InlineFile) -> _Entry:
+        entry = _Entry(inline_file)
+        if inline_file.encoded_size > self.max_bytes:
+            # Не помещается в бюджет: отдаём один раз и закрываем после запроса
+            entry.evicted = True
+            return entry
+
+        self._entries[unique_id] = entry
+        self.bytes += inline_file.encoded_size
+        while self.bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self.bytes -= old.file.encoded_size
+            old.evicted = True
+            if old.refs == 0:
+                old.close()
+        return entry
+
+    # === Дисковый уровень ===
+    def _disk_name(self, unique_id: str) -> str:
+        return hashlib.sha256(unique_id.encode("utf-8")).hexdigest()[:32]
+
+    def _scan_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".b64"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, name, size in sorted(files):
+            self._disk[name] = size
+            self._disk_total += size
+        self._trim_disk()
+
+    async def _read_disk(self, unique_id: str) -> Optional[InlineFile]:
+        name = self._disk_name(unique_id)
+        if name not in self._disk:
+            return None
+        self._disk.move_to_end(name)
+        try:
+            return await asyncio.to_thread(self._open_disk, name)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Не удалось прочитать файл из кеша: {e}")
+            self._forget_disk(name)
+            return None
+
+    def _open_disk(self, name: str) -> InlineFile:
+        base = os.path.join(self.directory, name)
+        with open(base + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        os.utime(base + ".b64")  # порядок LRU после перезапуска
+        return InlineFile.from_encoded_file(meta["mime_type"], open(base + ".b64", "rb"), meta["size"], meta["sha256"])
+
+    async def _write_disk(self, unique_id: str, entry: _Entry):
+        name = self._disk_name(unique_id)
+        inline_file = entry.file
+        try:
+            await asyncio.to_thread(self._save_disk, name, inline_file)
+        except Exception as e:
+            print(f"Ошибка записи файла в кеш на диске: {e}")
+            return
+        finally:
+            entry.refs -= 1
+            if entry.evicted and entry.refs == 0 and not entry.closed:
+                entry.close()
+        self._disk_total += inline_file.encoded_size - self._disk.pop(name, 0)
+        self._disk[name] = inline_file.encoded_size
+        self._trim_disk()
+
+    def _save_disk(self, name: str, inline_file: InlineFile):
+        base = os.path.join(self.directory, name)
+        with open(base + ".b64.tmp", "wb") as f:
+            for chunk in inline_file.iter_encoded():
+                f.write(chunk)
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump({"mime_type": inline_file.mime_type, "size": inline_file.size, "sha256": inline_file.sha256}, f)
+        os.replace(base + ".b64.tmp", base + ".b64")
+
+    def _trim_disk(self):
+        while self._disk_total > self.disk_bytes and self._disk:
+            name = next(iter(self._disk))
+            self._forget_disk(name)
+
+    def _forget_disk(self, name: str):
+        self._disk_total -= self._disk.pop(name, 0)
+        for suffix in (".b64", ".json"):
+            try:
+                os.remove(os.path.join(self.directory, name + suffix))
+            except OSError:
+                # Файл может быть открыт (Windows) или уже удалён
+                pass
@@ -0,0 +1,47 @@
+import os
+import asyncio
+from typing import Dict, List, Optional
+
+# === НАСТРОЙКИ СБОРА АЛЬБОМОВ ===
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.0"))
+# ===============================
+
+
+class _Group:
+    def __init__(self, deadline: float):
+        self.messages = []
+        self.deadline = deadline
+
+
+class MediaGroupCollector:
+    """Собирает сообщения альбома (media_group_id), которые Telegram присылает по одному.
+
+    Первый обработчик группы ждёт, пока новые части не перестанут приходить
+    window секунд подряд, и получает все сообщения альбома. Обработчики
+    остальных частей только добавляют своё сообщение и сразу завершаются.
+    Требует concurrent_updates, иначе следующие части не придут, пока ждёт первая.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW):
+        self.window = window
+        self._groups: Dict[str, _Group] = {}
+
+    async def collect(self, group_id: str, message) -> Optional[List]:
+        """Возвращает все сообщения альбома по порядку или None, если альбом обработает другой вызов."""
+        loop = asyncio.get_running_loop()
+        group = self._groups.get(group_id)
+        if group is not None:
+            group.messages.append(message)
+            group.deadline = loop.time() + self.window
+            return None
+
+        group = self._groups[group_id] = _Group(loop.time() + self.window)
+        group.messages.append(message)
+        try:
+            delay = self.window
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = group.deadline - loop.time()
+        finally:
+            del self._groups[group_id]
+        return sorted(group.messages, key=lambda m: m.message_id)
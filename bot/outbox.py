@@ -0,0 +1,209 @@
+import os
+import asyncio
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from shared.metrics import REGISTRY, stage
+
+# === НАСТРОЙКИ ОТПРАВКИ В TELEGRAM ===
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # вызовов в секунду на процесс
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в личке
+OUTBOX_GROUP_INTERVAL = float(os.getenv("OUTBOX_GROUP_INTERVAL", "3.0"))  # в группах лимит 20 в минуту
+OUTBOX_ACTION_TTL = float(os.getenv("OUTBOX_ACTION_TTL", "4.5"))  # «печатает...» держится около 5 секунд
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+# ===============================
+
+RETRY_AFTER = REGISTRY.counter("telegram_retry_after_total", "Ответов 429 от Telegram")
+SEND_ERRORS = REGISTRY.counter("telegram_send_errors_total", "Вызовов Telegram, завершившихся ошибкой")
+
+
+class _Job:
+    __slots__ = ("call", "future", "edit_key", "retries")
+
+    def __init__(self, call: Callable[[], Awaitable], edit_key: Optional[Tuple[int, int]] = None):
+        self.call = call
+        self.future = asyncio.get_running_loop().create_future()
+        self.edit_key = edit_key
+        self.retries = 0
+
+
+class _Chat:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.queue = deque()
+        self.edits: Dict[Tuple[int, int], _Job] = {}
+        self.next_at = 0.0
+        self.worker: Optional[asyncio.Task] = None
+
+
+class _RateLimiter:
+    """Равномерно раздаёт не больше rate слотов в секунду."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _seconds(value) -> float:
+    # retry_after бывает числом или timedelta в зависимости от версии python-telegram-bot
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+def _consume(future: asyncio.Future):
+    # Результат правки без ожидания никому не нужен, но ошибку стоит увидеть в логе
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Ошибка отправки в Telegram: {future.exception()}")
+
+
+class TelegramOutbox:
+    """Очередь исходящих вызовов Telegram с учётом лимитов.
+
+    Сообщения и правки одного чата уходят по очереди, не чаще раза в
+    chat_interval секунд (в группах — group_interval), всех чатов вместе —
+    не чаще global_rate в секунду. Если правка сообщения ещё ждёт в очереди,
+    новая правка того же сообщения заменяет её: уходит только последний
+    текст. Повторные «печатает...» в пределах action_ttl отбрасываются.
+    На 429 вызов повторяется после retry_after, а чат приостанавливается.
+    """
+
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE, chat_interval: float = OUTBOX_CHAT_INTERVAL,
+                 group_interval: float = OUTBOX_GROUP_INTERVAL, action_ttl: float = OUTBOX_ACTION_TTL,
+                 max_retries: int = OUTBOX_MAX_RETRIES):
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.action_ttl = action_ttl
+        self.max_retries = max_retries
+        self.coalesced = 0
+        self.dropped_actions = 0
+        self._limiter = _RateLimiter(global_rate)
+        self._chats: Dict[int, _Chat] = {}
+        self._actions = OrderedDict()  # chat_id -> время последнего «печатает...»
+
+    def export_metrics(self, registry=REGISTRY):
+        """Показывает в /metrics счётчики очереди (значения снимаются при запросе /metrics)."""
+        registry.counter_function("telegram_edits_coalesced_total", "Правок, заменённых более свежей",
+                                  lambda: self.coalesced)
+        registry.counter_function("telegram_actions_dropped_total", "Повторных «печатает...» отброшено",
+                                  lambda: self.dropped_actions)
+        registry.gauge_function("telegram_outbox_queued", "Вызовов в очередях чатов",
+                                lambda: sum(len(chat.queue) for chat in list(self._chats.values())))
+
+    def _chat(self, chat_id: int) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # У групп и каналов id отрицательные
+            chat = self._chats[chat_id] = _Chat(self.group_interval if chat_id < 0 else self.chat_interval)
+        return chat
+
+    # === Вызовы ===
+    def send_action(self, message, action: str = "TYPING"):
+        """Показывает «печатает...»; не ждёт отправки, повторы в пределах action_ttl отбрасываются."""
+        now = asyncio.get_running_loop().time()
+        while self._actions and now - next(iter(self._actions.values())) >= self.action_ttl:
+            self._actions.popitem(last=False)
+        if message.chat_id in self._actions:
+            self.dropped_actions += 1
+            return
+        self._actions[message.chat_id] = now
+
+        async def send():
+            await self._limiter.wait()
+            await message.chat.send_action(action=action)
+
+        # Действие не занимает очередь сообщений чата
+        asyncio.create_task(send()).add_done_callback(_consume)
+
+    async def reply_text(self, message, text: str, **kwargs):
+        """Ответ на сообщение; возвращает отправленное сообщение."""
+        future = self._enqueue(message.chat_id, _Job(lambda: message.reply_text(text, **kwargs)))
+        return await asyncio.shield(future)
+
+    async def edit_text(self, message, text: str, wait: bool = True, **kwargs):
+        """Правка сообщения. Ожидающая правка того же сообщения заменяется этой.
+
+        wait=False — не ждать отправки (промежуточный текст потокового ответа).
+        """
+        chat = self._chat(message.chat_id)
+        key = (message.chat_id, message.message_id)
+        call = lambda: message.edit_text(text, **kwargs)  # noqa: E731
+
+        job = chat.edits.get(key)
+        if job is not None:
+            job.call = call
+            self.coalesced += 1
+            future = job.future
+        else:
+            future = self._enqueue(message.chat_id, _Job(call, key))
+
+        if not wait:
+            future.add_done_callback(_consume)
+            return None
+        return await asyncio.shield(future)
+
+    # === Очередь чата ===
+    def _enqueue(self, chat_id: int, job: _Job) -> asyncio.Future:
+        chat = self._chat(chat_id)
+        chat.queue.append(job)
+        if job.edit_key is not None:
+            chat.edits[job.edit_key] = job
+        if chat.worker is None:
+            chat.worker = asyncio.create_task(self._drain(chat_id, chat))
+        return job.future
+
+    async def _drain(self, chat_id: int, chat: _Chat):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                delay = chat.next_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # Пауза выдержана и очередь пуста — чат больше не нужен
+                if not chat.queue:
+                    break
+                await self._limiter.wait()
+
+                job = chat.queue[0]
+                # С этого момента правку уже не заменить — следующая встанет в очередь
+                if job.edit_key is not None and chat.edits.get(job.edit_key) is job:
+                    del chat.edits[job.edit_key]
+                try:
+                    with stage("telegram_send"):
+                        result = await job.call()
+                except RetryAfter as e:
+                    RETRY_AFTER.inc()
+                    chat.next_at = loop.time() + _seconds(e.retry_after)
+                    job.retries += 1
+                    if job.retries <= self.max_retries:
+                        print(f"Лимит Telegram в чате {chat_id}, повтор через {e.retry_after}")
+                        continue
+                    chat.queue.popleft()
+                    job.future.set_exception(e)
+                    continue
+                except Exception as e:
+                    SEND_ERRORS.inc()
+                    chat.queue.popleft()
+                    job.future.set_exception(e)
+                else:
+                    chat.queue.popleft()
+                    job.future.set_result(result)
+                chat.next_at = loop.time() + chat.interval
+        finally:
+            chat.worker = None
+            if not chat.queue:
+                self._chats.pop(chat_id, None)
+
+    async def join(self):
+        """Дожидается отправки всего, что уже в очереди (при остановке бота)."""
+        workers = [chat.worker for chat in self._chats.values() if chat.worker is not None]
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,270 @@
+import os
+import hmac
+import zlib
+import signal
+import asyncio
+import multiprocessing
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+
+from shared.http_session import get_session
+from shared.metrics import metrics_handler
+
+# === НАСТРОЙКИ РЕЖИМА WEBHOOK ===
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_INTERNAL_PORT = int(os.getenv("WEBHOOK_INTERNAL_PORT", "9000"))
+WEBHOOK_PEERS = os.getenv("WEBHOOK_PEERS", "")  # внутренние адреса всех воркеров всех экземпляров
+WEBHOOK_INSTANCE = int(os.getenv("WEBHOOK_INSTANCE", "0"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_FORWARD_TIMEOUT = float(os.getenv("WEBHOOK_FORWARD_TIMEOUT", "5"))
+# ===============================
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FORWARDED_HEADER = "X-Bot-Forwarded"
+
+# Сколько последних update_id помнить, чтобы не обработать повторную доставку дважды
+SEEN_UPDATES = 10000
+
+# Обновления, у которых есть чат или отправитель, по которым их можно упорядочить
+_UPDATE_KINDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post", "callback_query",
+    "my_chat_member", "chat_member", "chat_join_request", "inline_query", "chosen_inline_result",
+)
+
+
+def chat_key(data: dict) -> Optional[str]:
+    """Чат обновления (или пользователь, если чата нет) — единица упорядочивания."""
+    for kind in _UPDATE_KINDS:
+        item = data.get(kind)
+        if not item:
+            continue
+        chat = item.get("chat") or (item.get("message") or {}).get("chat")
+        if chat:
+            return str(chat["id"])
+        if item.get("from"):
+            return f"user:{item['from']['id']}"
+    return None
+
+
+def owner_of(key: Optional[str], workers: int) -> int:
+    """Номер воркера, который ведёт чат. crc32, а не hash(): номер одинаков во всех процессах."""
+    if key is None or workers <= 1:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % workers
+
+
+def _is_album_part(data: dict) -> bool:
+    return bool((data.get("message") or {}).get("media_group_id"))
+
+
+def parse_peers(value: str = WEBHOOK_PEERS, workers: int = WEBHOOK_WORKERS,
+                internal_port: int = WEBHOOK_INTERNAL_PORT) -> List[str]:
+    """Внутренние адреса воркеров. Без WEBHOOK_PEERS — воркеры этого экземпляра на localhost."""
+    peers = [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+    return peers or [f"http://127.0.0.1:{internal_port + i}" for i in range(workers)]
+
+
+class ChatSequencer:
+    """Обрабатывает обновления одного чата строго по очереди, разных чатов — параллельно.
+
+    Следующее сообщение чата начинает обрабатываться только после ответа на
+    предыдущее, поэтому оно видит его в истории. Очередь чата живёт, пока
+    в ней есть обновления.
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, deque] = {}
+        self._tasks = set()
+
+    def submit(self, key: Optional[str], job: Callable[[], Awaitable]):
+        if key is None:
+            self._spawn(self._run(job))
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(job)
+            return
+        self._queues[key] = deque([job])
+        self._spawn(self._drain(key))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _run(job: Callable[[], Awaitable]):
+        try:
+            await job()
+        except Exception as e:
+            print(f"Ошибка обработки обновления: {e}")
+
+    async def _drain(self, key: str):
+        queue = self._queues[key]
+        try:
+            while queue:
+                await self._run(queue[0])
+                queue.popleft()
+        finally:
+            del self._queues[key]
+
+    async def join(self):
+        """Дожидается обработки всех принятых обновлений (при остановке)."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def _forward(peer: str, path: str, data: dict, secret: str) -> bool:
+    session = await get_session()
+    try:
+        async with session.post(
+            f"{peer}{path}", json=data,
+            headers={SECRET_HEADER: secret, FORWARDED_HEADER: "1"},
+            timeout=aiohttp.ClientTimeout(total=WEBHOOK_FORWARD_TIMEOUT),
+        ) as r:
+            return r.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Не удалось передать обновление воркеру {peer}: {e}")
+        return False
+
+
+def create_webhook_app(application, worker: int, peers: List[str], secret: str = WEBHOOK_SECRET,
+                       path: str = WEBHOOK_PATH) -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram для воркера с номером worker.
+
+    Обновление чужого чата передаётся его воркеру (peers[owner_of(...)]), так что
+    каждый чат всегда обрабатывается одним процессом: порядок сообщений и кеш
+    истории в памяти остаются согласованными. Чужой чат на месте не обрабатывается
+    никогда: если передать обновление не удалось, Telegram получает 503 и доставит
+    его повторно, а владелец, который мог его уже принять (таймаут), отбросит повтор
+    по update_id. Части альбома не упорядочиваются — их собирает
+    MediaGroupCollector, которому нужно получить их одновременно.
+    """
+    sequencer = ChatSequencer()
+    seen = OrderedDict()  # update_id уже принятых обновлений
+
+    async def receive(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            raise web.HTTPForbidden()
+        try:
+            data = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        key = chat_key(data)
+        owner = owner_of(key, len(peers))
+        if owner != worker and not request.headers.get(FORWARDED_HEADER):
+            if await _forward(peers[owner], path, data, secret):
+                return web.Response()
+            # У этого воркера устаревший кеш истории чата, а его отложенная запись
+            # перетёрла бы записи владельца — ждём повторной доставки владельцу
+            raise web.HTTPServiceUnavailable()
+
+        update_id = data.get("update_id")
+        if update_id is not None:
+            if update_id in seen:
+                return web.Response()
+            seen[update_id] = True
+            if len(seen) > SEEN_UPDATES:
+                seen.popitem(last=False)
+
+        update = Update.de_json(data, application.bot)
+        sequencer.submit(None if _is_album_part(data) else key, lambda: application.process_update(update))
+        # Telegram ждёт только подтверждения приёма, ответ пользователю уходит отдельно
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "worker": worker})
+
+    app = web.Application()
+    app["sequencer"] = sequencer
+    app.router.add_post(path, receive)
+    app.router.add_get("/health", health)
+    # У каждого воркера свои метрики: снимать их нужно с внутренних портов воркеров
+    app.router.add_get("/metrics", metrics_handler)
+    return app
+
+
+async def serve_worker(application, worker: int, peers: List[str], local_index: int = 0):
+    """Запускает один воркер: приложение бота, приём обновлений и (у первого воркера) setWebhook."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    web_app = create_webhook_app(application, worker, peers)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    # Публичный порт общий для воркеров экземпляра (SO_REUSEPORT), внутренний — свой у каждого
+    await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT, reuse_port=True).start()
+    if len(peers) > 1:
+        await web.TCPSite(runner, "0.0.0.0", WEBHOOK_INTERNAL_PORT + local_index).start()
+
+    if worker == 0:
+        await application.bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    print(f"✅ Воркер {worker} принимает обновления на порту {WEBHOOK_PORT}.")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Сначала перестаём принимать, затем доделываем уже принятые обновления
+    await runner.cleanup()
+    await web_app["sequencer"].join()
+    await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    await application.shutdown()
+
+
+def _worker_main(build_application: Callable, worker: int, peers: List[str], local_index: int):
+    asyncio.run(serve_worker(build_application(), worker, peers, local_index))
+
+
+def run_webhook(build_application: Callable):
+    """Режим webhook: WEBHOOK_WORKERS процессов на экземпляр, чаты распределены между ними по crc32.
+
+    build_application вызывается в каждом процессе и возвращает собранное
+    приложение python-telegram-bot (с post_init/post_shutdown).
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("Для режима webhook задайте WEBHOOK_URL и WEBHOOK_SECRET")
+
+    peers = parse_peers()
+    first = WEBHOOK_INSTANCE * WEBHOOK_WORKERS
+    if WEBHOOK_WORKERS == 1:
+        _worker_main(build_application, first, peers, 0)
+        return
+
+    processes = [
+        multiprocessing.Process(target=_worker_main, args=(build_application, first + i, peers, i),
+                                name=f"bot-worker-{i}")
+        for i in range(WEBHOOK_WORKERS)
+    ]
+    for process in processes:
+        process.start()
+
+    def terminate(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    for process in processes:
+        process.join()
@@ -0,0 +1,8 @@
+from async_server import create_app
+
+# gunicorn aio:app --worker-class aiohttp.GunicornWebWorker
+app = create_app()
+
+if __name__ == "__main__":
+    from aiohttp import web
+    web.run_app(app)
\ No newline at end of file
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import base64
+import asyncio
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+import aiohttp
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.admission import QueueFullError  # noqa: E402
+from shared.documents import analyze_chunks, split_document, worth_splitting  # noqa: E402
+from shared.gemini_client import gemini_client  # noqa: E402
+from shared.history_budget import HistoryManager  # noqa: E402
+from shared.image_prep import can_resize, prepare_image, prepare_image_base64  # noqa: E402
+from shared.inline_file import FileTooLargeError, InlineFile, encode_stream, limit_size  # noqa: E402
+from shared.metrics import stage  # noqa: E402
+from shared.offload import run_io  # noqa: E402
+from shared.resilience import CircuitOpenError, ProxyStatusError  # noqa: E402
+from shared.session_store import create_session_store  # noqa: E402
+
+# Логика маршрутов общая для Flask (server.py) и aiohttp (async_server.py):
+# каждая функция принимает JSON запроса и возвращает (тело ответа, HTTP-статус).
+
+# Предел размера файла в бинарной загрузке (как у файлов бота)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Пакетные запросы (/api/batch)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+BATCH_QUEUE_TIMEOUT = float(os.getenv("BATCH_QUEUE_TIMEOUT", "120"))
+# Пункты без user_id делят одну очередь к прокси и не теснят интерактивных пользователей
+BATCH_USER_KEY = "batch"
+
+# Очередь и пул прокси в /metrics
+gemini_client.export_metrics()
+
+# История диалогов: в памяти процесса или в sqlite, общем для воркеров (SESSION_STORE)
+sessions = create_session_store()
+
+# В запрос идёт столько последней истории, сколько влезает в бюджет токенов
+history_manager = HistoryManager(gemini_client)
+
+
+async def chat(data: dict):
+    user_id = data.get('user_id')
+    message = data.get('message')
+
+    if not user_id or not message:
+        return {'error': 'Missing user_id or message'}, 400
+
+    history = await history_manager.prepare(str(user_id), await sessions.get(user_id), message)
+    try:
+        response = await gemini_client.query_gemini(message, history=history, user_key=str(user_id))
+    except QueueFullError as e:
+        return {'error': str(e)}, 429
+
+    # Обновляем историю
+    await sessions.append(
+        user_id,
+        {"role": "user", "parts": [{"text": message}]},
+        {"role": "model", "parts": [{"text": response}]},
+    )
+
+    return {'response': response}, 200
+
+
+async def chat_stream(data: dict):
+    """Потоковый вариант chat: возвращает (генератор SSE-событий, 200) или (ошибка, статус)."""
+    user_id = data.get('user_id')
+    message = data.get('message')
+
+    if not user_id or not message:
+        return {'error': 'Missing user_id or message'}, 400
+
+    return _chat_events(user_id, message), 200
+
+
+async def _chat_events(user_id, message):
+    history = await history_manager.prepare(str(user_id), await sessions.get(user_id), message)
+    chunks = []
+
+    try:
+        async for delta in gemini_client.stream_gemini(message, history=history, user_key=str(user_id)):
+            chunks.append(delta)
+            yield sse_event({'delta': delta})
+    except QueueFullError as e:
+        yield sse_event({'error': str(e)})
+        return
+
+    response = "".join(chunks)
+
+    # Обновляем историю только после полного ответа
+    await sessions.append(
+        user_id,
+        {"role": "user", "parts": [{"text": message}]},
+        {"role": "model", "parts": [{"text": response}]},
+    )
+
+    yield sse_event({'done': True, 'response': response})
+
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _ask_file(ask: Callable, prompt: str, file_data: str, mime_type: str, user_key: str,
+                    queue_timeout: Optional[float] = None) -> str:
+    """Запрос по файлу в base64 через ask (query_gemini или generate)."""
+    # Большой текст или PDF разбираем по частям
+    if worth_splitting(mime_type, len(file_data) * 3 // 4):
+        with stage("decode"):
+            data = await run_io(base64.b64decode, file_data, size=len(file_data))
+        with stage("split"):
+            chunks = await split_document(data, mime_type)
+        if chunks:
+            return await analyze_chunks(gemini_client, prompt, chunks, user_key=user_key,
+                                        queue_timeout=queue_timeout)
+
+    # Оригиналы с телефона уменьшаем до разумного для модели размера
+    with stage("image_prep"):
+        file_data = await prepare_image_base64(file_data, mime_type)
+    return await ask(prompt, file_data=file_data, mime_type=mime_type, user_key=user_key,
+                     queue_timeout=queue_timeout)
+
+
+async def upload(data: dict):
+    try:
+        user_id = data.get('user_id')
+        file_data = data.get('file_data')
+        mime_type = data.get('mime_type')
+        prompt = data.get('prompt', 'Опиши этот файл')
+
+        if not all([user_id, file_data, mime_type]):
+            return {'error': 'Missing required fields'}, 400
+
+        response = await _ask_file(gemini_client.query_gemini, prompt, file_data, mime_type, str(user_id))
+        return {'response': response}, 200
+
+    except QueueFullError as e:
+        return {'error': str(e)}, 429
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def upload_binary(fields: Mapping[str, str], mime_type: Optional[str], chunks: AsyncIterator[bytes],
+                        size: Optional[int] = None, size_bound: Optional[int] = None):
+    """Загрузка файла байтами (multipart) вместо base64 в JSON.
+
+    chunks — содержимое файла по частям по мере чтения запроса, size — точный
+    размер, если известен, size_bound — верхняя граница (длина всего запроса).
+    Файл кодируется в base64 по частям и уходит в прокси потоком; целиком в
+    память читаются только картинки для уменьшения и документы, которые могут
+    оказаться достаточно большими для разбора по частям.
+    """
+    user_id = fields.get('user_id')
+    prompt = fields.get('prompt') or 'Опиши этот файл'
+
+    if not user_id or not mime_type:
+        return {'error': 'Missing required fields'}, 400
+    if size and size > UPLOAD_MAX_BYTES:
+        return {'error': f'File is larger than {UPLOAD_MAX_BYTES // (1024 * 1024)} MB'}, 413
+
+    chunks = limit_size(chunks, UPLOAD_MAX_BYTES)
+    try:
+        # Размер совсем неизвестен (chunked) — документ отправляем потоком целиком
+        if can_resize(mime_type) or worth_splitting(mime_type, size or size_bound):
+            with stage("upload"):
+                data = b"".join([chunk async for chunk in chunks])
+            with stage("split"):
+                document_chunks = await split_document(data, mime_type)
+            if document_chunks:
+                response = await analyze_chunks(gemini_client, prompt, document_chunks, user_key=str(user_id))
+                return {'response': response}, 200
+            with stage("image_prep"):
+                data = await prepare_image(data, mime_type)
+            with stage("encode"):
+                inline_file = await InlineFile.from_bytes_async(mime_type, data)
+        else:
+            # Приём и кодирование идут вместе, по мере поступления частей
+            with stage("upload"):
+                inline_file = await encode_stream(chunks, mime_type)
+
+        try:
+            response = await gemini_client.query_gemini(prompt, inline_file, mime_type, user_key=str(user_id))
+        finally:
+            inline_file.close()
+
+        return {'response': response}, 200
+
+    except FileTooLargeError as e:
+        return {'error': str(e)}, 413
+    except QueueFullError as e:
+        return {'error': str(e)}, 429
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def batch(data: dict):
+    """Несколько запросов за один вызов.
+
+    items — список объектов {id?, message, user_id?, file_data?, mime_type?}.
+    С user_id в запрос идёт история этого пользователя, но ответы в неё не
+    записываются. Одновременно выполняется не больше BATCH_CONCURRENCY пунктов.
+    Возвращает ({'results': [...]} в порядке items, 200), а со stream=True —
+    (генератор строк NDJSON по мере готовности, 200). Ошибка пункта попадает
+    в его результат (error и status) и не прерывает остальные.
+    """
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return {'error': 'Missing items'}, 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return {'error': f'Too many items, at most {BATCH_MAX_ITEMS}'}, 413
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(index: int, item) -> dict:
+        async with semaphore:
+            return await _batch_item(index, item)
+
+    if data.get('stream'):
+        return _batch_events(items, run), 200
+
+    results = await asyncio.gather(*(run(index, item) for index, item in enumerate(items)))
+    return {'results': results}, 200
+
+
+async def _batch_events(items: list, run: Callable):
+    tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+    finally:
+        # Клиент отключился — оставшиеся пункты больше не нужны
+        for task in tasks:
+            task.cancel()
+
+
+async def _batch_item(index: int, item) -> dict:
+    if not isinstance(item, dict):
+        return {'index': index, 'error': 'Item must be an object', 'status': 400}
+
+    result = {'index': index}
+    if 'id' in item:
+        result['id'] = item['id']
+
+    user_id = item.get('user_id')
+    message = item.get('message')
+    file_data = item.get('file_data')
+    mime_type = item.get('mime_type')
+    if not message and not file_data:
+        return {**result, 'error': 'Missing message', 'status': 400}
+    if file_data and not mime_type:
+        return {**result, 'error': 'Missing mime_type', 'status': 400}
+
+    user_key = str(user_id) if user_id else BATCH_USER_KEY
+    try:
+        # Пакет не торопится: при переполненной очереди ждём места, а не отказываем сразу
+        if file_data:
+            response = await _ask_file(gemini_client.generate, message or 'Опиши этот файл',
+                                       file_data, mime_type, user_key, queue_timeout=BATCH_QUEUE_TIMEOUT)
+        else:
+            history = None
+            if user_id:
+                history = await history_manager.prepare(str(user_id), await sessions.get(user_id), message)
+            response = await gemini_client.generate(message, history=history, user_key=user_key,
+                                                    queue_timeout=BATCH_QUEUE_TIMEOUT)
+        return {**result, 'response': response}
+
+    except QueueFullError as e:
+        return {**result, 'error': str(e), 'status': 429}
+    except CircuitOpenError as e:
+        return {**result, 'error': str(e), 'status': 503}
+    except (ProxyStatusError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return {**result, 'error': str(e), 'status': 502}
+    except Exception as e:
+        return {**result, 'error': str(e), 'status': 500}
+
+
+async def reset(data: dict):
+    user_id = data.get('user_id')
+
+    if user_id:
+        history_manager.reset(str(user_id))
+        await sessions.reset(user_id)
+
+    return {'success': True}, 200
+
+
+def health():
+    return {'status': 'ok', 'service': 'gemini-bot-api'}, 200
+
+
+def home():
+    return {'message': 'Gemini Bot API is running'}, 200
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+from typing import Optional
+
+from aiohttp import web
+
+import api
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.http_session import close_session  # noqa: E402
+from shared.metrics import metrics_handler, track  # noqa: E402
+from shared.offload import loop_monitor, shutdown as shutdown_offload  # noqa: E402
+
+# Асинхронная версия API-сервера на aiohttp.web: те же маршруты и JSON-контракт,
+# что и в server.py, но один воркер держит сотни одновременных запросов к Gemini.
+
+routes = web.RouteTableDef()
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+}
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Предел текстового поля формы (user_id, prompt) в /api/upload/binary
+FORM_FIELD_MAX_BYTES = 64 * 1024
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Аналог flask_cors.CORS(app): разрешает запросы с любого origin.
+
+    Заголовки нужны и ошибкам, брошенным как web.HTTPException (400 на битый JSON,
+    413 на слишком большое тело): без них браузер покажет непрозрачную ошибку CORS.
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            e.headers.update(CORS_HEADERS)
+            raise
+    response.headers.update(CORS_HEADERS)
+    return response
+
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(
+            text=json.dumps({'error': 'Invalid JSON'}),
+            content_type='application/json'
+        )
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Время, число и результат запросов по маршрутам (gemini_bot_handler_*)."""
+    resource = request.match_info.route.resource
+    name = resource.canonical if resource is not None else 'unmatched'
+    if name == '/metrics':
+        return await handler(request)
+    with track(name) as tracked:
+        response = await handler(request)
+        if response.status >= 500:
+            tracked.fail()
+        return response
+
+
+def _json_response(result):
+    body, status = result
+    return web.json_response(body, status=status)
+
+
+@routes.post('/api/chat')
+async def chat(request):
+    return _json_response(await api.chat(await _read_json(request)))
+
+
+@routes.post('/api/chat/stream')
+async def chat_stream(request):
+    result, status = await api.chat_stream(await _read_json(request))
+    if status != 200:
+        return web.json_response(result, status=status)
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', **SSE_HEADERS})
+    response.headers.update(CORS_HEADERS)
+    await response.prepare(request)
+    async for event in result:
+        await response.write(event.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+@routes.post('/api/upload')
+async def upload_file(request):
+    try:
+        return _json_response(await api.upload(await _read_json(request)))
+
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def _iter_part(part):
+    while True:
+        chunk = await part.read_chunk()
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _read_field(part) -> Optional[str]:
+    """Текстовое поле формы; None, если оно длиннее FORM_FIELD_MAX_BYTES."""
+    data = bytearray()
+    async for chunk in _iter_part(part):
+        data.extend(chunk)
+        if len(data) > FORM_FIELD_MAX_BYTES:
+            return None
+    return part.decode(bytes(data)).decode(part.get_charset(default='utf-8'))
+
+
+@routes.post('/api/upload/binary')
+async def upload_binary(request):
+    """multipart/form-data: текстовые поля user_id и prompt, затем файл в поле file.
+
+    Файл читается из запроса по частям прямо в кодировщик, без base64 от клиента
+    и без буфера на весь запрос (client_max_size к нему не применяется).
+    """
+    try:
+        reader = await request.multipart()
+    except (AssertionError, ValueError):
+        return web.json_response({'error': 'Expected multipart/form-data'}, status=400)
+
+    fields = {}
+    async for part in reader:
+        if part.name != 'file':
+            value = await _read_field(part)
+            if value is None:
+                return web.json_response({'error': f'Field {part.name} is too long'}, status=413)
+            fields[part.name] = value
+            continue
+        # Поля после файла не нужны: ответ строится по тому, что пришло до него.
+        # Браузерный FormData не указывает размер части, тогда файл не больше всего запроса.
+        size = part.headers.get('Content-Length')
+        return _json_response(await api.upload_binary(
+            fields, part.headers.get('Content-Type'), _iter_part(part), int(size) if size else None,
+            size_bound=request.content_length,
+        ))
+    return web.json_response({'error': 'Missing required fields'}, status=400)
+
+
+@routes.post('/api/batch')
+async def batch(request):
+    result, status = await api.batch(await _read_json(request))
+    if isinstance(result, dict):
+        return web.json_response(result, status=status)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', **SSE_HEADERS})
+    response.headers.update(CORS_HEADERS)
+    await response.prepare(request)
+    async for line in result:
+        await response.write(line.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+@routes.post('/api/reset')
+async def reset_history(request):
+    return _json_response(await api.reset(await _read_json(request)))
+
+
+@routes.get('/health')
+async def health(request):
+    return _json_response(api.health())
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    return await metrics_handler(request)
+
+
+@routes.get('/')
+async def home(request):
+    return _json_response(api.home())
+
+
+async def _on_startup(app):
+    loop_monitor.start()
+
+
+async def _on_cleanup(app):
+    await close_session()
+    await loop_monitor.stop()
+    shutdown_offload()
+
+
+def create_app() -> web.Application:
+    """Собирает aiohttp-приложение API."""
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware], client_max_size=32 * 1024 ** 2)
+    app.add_routes(routes)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
@@ -1,132 +1,186 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
+import sys
+import atexit
 import asyncio
-import aiohttp
+import threading
+
+import api
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.http_session import close_session  # noqa: E402
+from shared.inline_file import READ_CHUNK_SIZE  # noqa: E402
+from shared.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, finish_request, start_request  # noqa: E402
+from shared.offload import loop_monitor, run_io, shutdown as shutdown_offload  # noqa: E402
+
+# Поля формы, заголовки частей multipart и остальной JSON сверх самого файла
+FORM_OVERHEAD = 64 * 1024
+UPLOAD_MAX_BODY = api.UPLOAD_MAX_BYTES + FORM_OVERHEAD
 
 app = Flask(__name__)
+# Самое большое допустимое тело — файл в base64 (на треть больше) в JSON /api/upload.
+# Werkzeug отвечает 413, как только прочитано больше, а не после приёма всего тела.
+app.config['MAX_CONTENT_LENGTH'] = api.UPLOAD_MAX_BYTES * 4 // 3 + FORM_OVERHEAD
 CORS(app)
 
-# Простое хранилище в памяти
-user_sessions = {}
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Один фоновый event loop на процесс: на нём живёт общая HTTP-сессия,
+# а синхронные обработчики Flask отправляют туда корутины.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
 
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gemini-loop", daemon=True).start()
+            _loop.call_soon_threadsafe(loop_monitor.start)
+    return _loop
 
-class GeminiClient:
-    def __init__(self):
-        self.gas_url = os.getenv("GAS_PROXY_URL")
 
-    async def query_gemini(self, prompt: str, file_data: str = None,
-                           mime_type: str = None, history: list = None) -> str:
-        contents = history if history else []
+def run_async(coro):
+    """Выполняет корутину на фоновом цикле и ждёт результат."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
 
-        current_user_parts = []
 
-        if file_data and mime_type:
-            current_user_parts.append({
-                "inlineData": {
-                    "mimeType": mime_type,
-                    "data": file_data
-                }
-            })
+def iter_async(agen):
+    """Превращает асинхронный генератор в обычный для потоковых ответов Flask."""
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+
+@atexit.register
+def _shutdown_loop():
+    if _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(close_session(), _loop).result(timeout=5)
+        asyncio.run_coroutine_threadsafe(loop_monitor.stop(), _loop).result(timeout=5)
+        shutdown_offload()
+        _loop.call_soon_threadsafe(_loop.stop)
 
-        current_user_parts.append({"text": prompt})
 
-        contents.append({
-            "role": "user",
-            "parts": current_user_parts
-        })
+@app.before_request
+def _track_request():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if rule != '/metrics':
+        # g.tracked появляется только после учёта запроса — teardown закроет ровно то, что открыто
+        g.tracked = (rule, start_request(rule))
 
-        payload = {
-            "model": "gemini-2.5-flash",
-            "args": {
-                "contents": contents
-            }
-        }
 
-        try:
-            async with aiohttp.ClientSession() as s:
-                async with s.post(self.gas_url, json=payload, timeout=60) as r:
-                    r.raise_for_status()
-                    data = await r.json()
+@app.after_request
+def _track_status(response):
+    if response.status_code >= 500:
+        g.request_failed = True
+    return response
 
-                    text = (
-                        data.get("candidates", [{}])[0]
-                        .get("content", {})
-                        .get("parts", [{}])[0]
-                        .get("text", "")
-                    )
-                    return text or "Нет текста в ответе."
 
-        except Exception as e:
-            return f"Ошибка: {e}"
+@app.teardown_request
+def _track_done(exc):
+    tracked = g.pop('tracked', None)
+    if tracked is not None:
+        rule, started = tracked
+        finish_request(rule, started, exc is not None or g.pop('request_failed', False))
 
 
-gemini_client = GeminiClient()
+@app.errorhandler(RequestEntityTooLarge)
+def _too_large(e):
+    return jsonify({'error': f'File is larger than {api.UPLOAD_MAX_BYTES // (1024 * 1024)} MB'}), 413
 
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    data = request.json
-    user_id = data.get('user_id')
-    message = data.get('message')
+    body, status = run_async(api.chat(request.json))
+    return jsonify(body), status
 
-    if not user_id or not message:
-        return jsonify({'error': 'Missing user_id or message'}), 400
 
-    history = user_sessions.get(user_id, [])
-    response = asyncio.run(gemini_client.query_gemini(message, history=history))
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    result, status = run_async(api.chat_stream(request.json))
+    if status != 200:
+        return jsonify(result), status
 
-    # Обновляем историю
-    history.append({"role": "user", "parts": [{"text": message}]})
-    history.append({"role": "model", "parts": [{"text": response}]})
-    user_sessions[user_id] = history[-4:]
-
-    return jsonify({'response': response})
+    return Response(iter_async(result), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
+    data = request.json  # слишком большое тело — 413 из обработчика выше, а не 500
     try:
-        data = request.json
-        user_id = data.get('user_id')
-        file_data = data.get('file_data')
-        mime_type = data.get('mime_type')
-        prompt = data.get('prompt', 'Опиши этот файл')
+        body, status = run_async(api.upload(data))
+        return jsonify(body), status
 
-        if not all([user_id, file_data, mime_type]):
-            return jsonify({'error': 'Missing required fields'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        response = asyncio.run(gemini_client.query_gemini(
-            prompt,
-            file_data=file_data,
-            mime_type=mime_type
-        ))
 
-        return jsonify({'response': response})
+async def _iter_stream(stream):
+    # Werkzeug уже сложил файл во временный файл (или в память, если он мал) — читаем его частями
+    while True:
+        chunk = await run_io(stream.read, READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
 
+@app.route('/api/upload/binary', methods=['POST'])
+def upload_binary():
+    """multipart/form-data: поля user_id и prompt, файл в поле file."""
+    # Общий предел рассчитан на base64; байтам файла столько не нужно — отказываем до чтения тела
+    if request.content_length is not None and request.content_length > UPLOAD_MAX_BODY:
+        raise RequestEntityTooLarge()
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({'error': 'Missing required fields'}), 400
+
+    # Файл уже принят целиком, так что размер известен точно
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    body, status = run_async(api.upload_binary(request.form, file.mimetype, _iter_stream(file.stream), size))
+    return jsonify(body), status
 
-@app.route('/api/reset', methods=['POST'])
-def reset_history():
-    data = request.json
-    user_id = data.get('user_id')
 
-    if user_id in user_sessions:
-        user_sessions[user_id] = []
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    result, status = run_async(api.batch(request.json))
+    if isinstance(result, dict):
+        return jsonify(result), status
 
-    return jsonify({'success': True})
+    return Response(iter_async(result), mimetype='application/x-ndjson', headers=SSE_HEADERS)
+
+
+@app.route('/api/reset', methods=['POST'])
+def reset_history():
+    body, status = run_async(api.reset(request.json))
+    return jsonify(body), status
 
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'service': 'gemini-bot-api'})
+    body, status = api.health()
+    return jsonify(body), status
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
 
 
 @app.route('/')
 def home():
-    return jsonify({'message': 'Gemini Bot API is running'})
+    body, status = api.home()
+    return jsonify(body), status
 
 
 if __name__ == '__main__':
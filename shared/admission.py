@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+# === НАСТРОЙКИ ДОПУСКА ЗАПРОСОВ К ПРОКСИ ===
+MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "8"))
+MAX_QUEUE_PER_USER = int(os.getenv("GEMINI_MAX_QUEUE_PER_USER", "3"))
+MAX_QUEUE_TOTAL = int(os.getenv("GEMINI_MAX_QUEUE", "100"))
+MAX_RETRY_AFTER = float(os.getenv("GEMINI_MAX_RETRY_AFTER", "30"))
+# ===============================
+
+
+class QueueFullError(Exception):
+    """Очередь к прокси переполнена — запрос отклонён сразу, без ожидания."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды), ограничивая сверху MAX_RETRY_AFTER."""
+    if not value:
+        return None
+    try:
+        return min(max(float(value), 0.0), MAX_RETRY_AFTER)
+    except ValueError:
+        return None
+
+
+class AdmissionController:
+    """Ограничивает число одновременных запросов к прокси и честно делит их между пользователями.
+
+    Свободные слоты выдаются сразу. Остальные запросы ждут в очередях по
+    ключу пользователя/чата, которые обслуживаются по кругу (round-robin),
+    поэтому один активный чат не занимает всю квоту. При переполнении
+    очереди запрос отклоняется QueueFullError — сразу или, если задан timeout,
+    когда место в очереди не освободилось за это время. После 429/503 с
+    Retry-After выдача слотов приостанавливается на указанное время.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, max_queue_per_user: int = MAX_QUEUE_PER_USER,
+                 max_queue_total: int = MAX_QUEUE_TOTAL):
+        self.max_in_flight = max_in_flight
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue_total = max_queue_total
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._queues = OrderedDict()  # ключ пользователя -> deque ожидающих future
+        self._space: Optional[asyncio.Event] = None  # ожидающие места в переполненной очереди
+        self._paused_until = 0.0
+        self._resume_handle = None
+
+    def _paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    def _full(self, key: str) -> bool:
+        queue = self._queues.get(key)
+        return self.queued >= self.max_queue_total or bool(queue and len(queue) >= self.max_queue_per_user)
+
+    async def acquire(self, user_key: Optional[str] = None, timeout: Optional[float] = None):
+        """Занимает слот. timeout — сколько секунд ждать места в переполненной очереди
+        (None — отклонить сразу); дальше запрос ждёт своей очереди как обычно."""
+        key = user_key or ""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            if self.in_flight < self.max_in_flight and not self._queues and not self._paused():
+                self.in_flight += 1
+                return
+            if not self._full(key):
+                break
+            remaining = 0.0 if deadline is None else deadline - loop.time()
+            if remaining <= 0:
+                self.rejected += 1
+                raise QueueFullError("Слишком много запросов в очереди к Gemini, попробуйте чуть позже.")
+            if self._space is None:
+                self._space = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._space.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        queue = self._queues.get(key)
+        future = loop.create_future()
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(future)
+        self.queued += 1
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменён — возвращаем слот
+                self.release()
+            else:
+                self._discard(key, future)
+            raise
+
+    def try_acquire(self) -> bool:
+        """Занимает слот, только если он свободен прямо сейчас, без очереди."""
+        if self.in_flight < self.max_in_flight and not self._queues and not self._paused():
+            self.in_flight += 1
+            return True
+        return False
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_key: Optional[str] = None, wait: bool = True, timeout: Optional[float] = None):
+        """Слот на время запроса; с wait=False — только свободный, иначе QueueFullError."""
+        if wait:
+            await self.acquire(user_key, timeout)
+        elif not self.try_acquire():
+            raise QueueFullError("Нет свободного слота к прокси.")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу слотов (прокси ответил Retry-After)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _discard(self, key: str, future: asyncio.Future):
+        queue = self._queues.get(key)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self._queues[key]
+            self._notify_space()
+
+    def _notify_space(self):
+        # Будим всех ждущих места: каждый сам проверит, освободилось ли место в его очереди
+        if self._space is not None:
+            self._space.set()
+            self._space = None
+
+    def _dispatch(self):
+        if self._paused():
+            if self._resume_handle is None:
+                delay = self._paused_until - time.monotonic()
+                self._resume_handle = asyncio.get_running_loop().call_later(delay, self._resume)
+            return
+
+        while self.in_flight < self.max_in_flight and self._queues:
+            key, queue = self._queues.popitem(last=False)
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # Пользователь с оставшимися запросами уходит в конец круга
+                self._queues[key] = queue
+            self._notify_space()
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _resume(self):
+        self._resume_handle = None
+        self._dispatch()
@@ -0,0 +1,151 @@
+import os
+import time
+import json
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from shared.inline_file import InlineFile
+
+# === НАСТРОЙКИ КЕША ОТВЕТОВ ===
+CACHE_BACKEND = os.getenv("GEMINI_CACHE", "memory")  # memory | sqlite | off
+CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_SIZE", "500"))
+CACHE_PATH = os.getenv("GEMINI_CACHE_PATH", "gemini_cache.sqlite3")
+# ===============================
+
+
+def _normalize(value):
+    """Приводит contents к стабильному виду: текст в NFC без крайних пробелов,
+    файлы заменены дайджестом содержимого."""
+    if isinstance(value, dict):
+        if "inlineData" in value:
+            inline = value["inlineData"]
+            data = inline.get("data", "")
+            if isinstance(data, InlineFile):
+                digest = data.sha256
+            else:
+                digest = hashlib.sha256(data.encode("ascii")).hexdigest()
+            return {"inlineData": {"mimeType": inline.get("mimeType"), "sha256": digest}}
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        return unicodedata.normalize("NFC", value).strip()
+    return value
+
+
+def make_cache_key(payload: Dict) -> str:
+    """Ключ кеша: хеш модели и нормализованного содержимого запроса."""
+    canonical = json.dumps(
+        {"model": payload.get("model"), "contents": _normalize(payload.get("args", {}).get("contents", []))},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """LRU-кеш в памяти процесса с ограничением по числу записей и TTL."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    async def set(self, key: str, value: str):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {"backend": "memory", "hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class SqliteCache:
+    """Кеш в sqlite-файле, общий для нескольких процессов (бот, воркеры gunicorn).
+
+    Запросы к базе выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await asyncio.to_thread(self._get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        await asyncio.to_thread(self._set, key, value)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"backend": "sqlite", "hits": self.hits, "misses": self.misses, "size": size}
+
+
+def create_cache():
+    """Создаёт кеш ответов согласно GEMINI_CACHE (memory, sqlite или off)."""
+    if CACHE_BACKEND == "sqlite":
+        return SqliteCache()
+    if CACHE_BACKEND == "memory":
+        return MemoryCache()
+    return None
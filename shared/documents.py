@@ -0,0 +1,224 @@
+import io
+import os
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pypdf необязателен: без него PDF уходит в модель целиком, как раньше
+    PdfReader = None
+
+from shared.admission import QueueFullError
+from shared.offload import run_cpu
+
+# === НАСТРОЙКИ РАЗБОРА БОЛЬШИХ ДОКУМЕНТОВ ===
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", "6000"))
+DOC_MAP_CONCURRENCY = int(os.getenv("DOC_MAP_CONCURRENCY", "3"))
+# Части делят очередь к прокси с другими запросами того же чата: при переполнении ждут места
+DOC_QUEUE_TIMEOUT = float(os.getenv("DOC_QUEUE_TIMEOUT", "120"))
+# PDF меньше этого размера отправляется целиком, без скачивания в память и разбора
+DOC_PDF_SPLIT_BYTES = int(os.getenv("DOC_PDF_SPLIT_BYTES", str(1024 * 1024)))
+# ===============================
+
+CHARS_PER_TOKEN = 4  # грубая оценка без токенизатора
+PDF_PROBE_PAGES = 3  # если на первых страницах нет текста, это скан — дальше не разбираем
+DOCUMENT_MIMES = {"text/plain", "application/pdf"}
+
+MAP_PROMPT = (
+    "Это часть {index} из {total} большого документа. Запрос пользователя к документу:\n"
+    "{prompt}\n\n"
+    "Выпиши из этой части всё, что нужно для ответа на запрос, кратко и по существу. "
+    "Если в части ничего относящегося к запросу нет, ответь одним словом: НЕТ.\n\n"
+    "--- Часть {index} ---\n{chunk}"
+)
+
+REDUCE_PROMPT = (
+    "Документ был слишком большим и разобран по частям. Ниже выдержки из частей.\n"
+    "Запрос пользователя к документу:\n{prompt}\n\n"
+    "Составь по этим выдержкам один связный ответ на запрос, не упоминая деление на части.\n\n"
+    "{partials}"
+)
+
+Progress = Callable[[int, int], Awaitable[None]]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def decode_text(data: bytes) -> str:
+    """Текстовые файлы присылают и в UTF-8, и в cp1251."""
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def extract_sections(data: bytes, mime_type: str) -> List[str]:
+    """Текст документа по разделам (страницам PDF). Пустой список — текст извлечь нельзя.
+
+    Синхронная — вызывать через run_cpu.
+    """
+    if mime_type == "text/plain":
+        return [decode_text(data)]
+    if mime_type == "application/pdf" and PdfReader is not None:
+        try:
+            reader = PdfReader(io.BytesIO(data))
+            pages = []
+            for page in reader.pages:
+                pages.append(page.extract_text() or "")
+                if len(pages) == PDF_PROBE_PAGES and not any(text.strip() for text in pages):
+                    break
+        except Exception as e:
+            print(f"Не удалось извлечь текст из PDF: {e}")
+            return []
+        # Скан без текстового слоя модель прочитает сама
+        if not any(page.strip() for page in pages):
+            return []
+        return [f"[Страница {number}]\n{page}" for number, page in enumerate(pages, 1) if page.strip()]
+    return []
+
+
+def split_text(text: str, max_tokens: int = DOC_CHUNK_TOKENS) -> List[str]:
+    """Режет текст на куски не больше max_tokens: по абзацам, затем по строкам, затем по длине."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+
+    for separator in ("\n\n", "\n", " "):
+        parts = text.split(separator)
+        if len(parts) > 1:
+            break
+    else:
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+    chunks, current = [], ""
+    for part in parts:
+        candidate = f"{current}{separator}{part}" if current else part
+        if len(candidate) <= max_chars:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        if len(part) > max_chars:
+            chunks.extend(split_text(part, max_tokens))
+            current = ""
+        else:
+            current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def pack_sections(sections: List[str], max_tokens: int = DOC_CHUNK_TOKENS) -> List[str]:
+    """Собирает разделы (страницы) в куски по бюджету, большие разделы режет."""
+    pieces = [piece for section in sections for piece in split_text(section, max_tokens)]
+    return split_text("\n\n".join(pieces), max_tokens) if pieces else []
+
+
+def worth_splitting(mime_type: Optional[str], file_size: Optional[int], max_tokens: int = DOC_CHUNK_TOKENS) -> bool:
+    """Стоит ли скачивать документ для разбора по частям, судя по размеру файла.
+
+    В текстовом файле символов не больше, чем байт, так что маленький файл
+    заведомо помещается в один запрос. Размер PDF о тексте говорит мало (это
+    могут быть картинки и шрифты), поэтому для него свой порог DOC_PDF_SPLIT_BYTES.
+    """
+    if mime_type not in DOCUMENT_MIMES or not file_size:
+        return False
+    if mime_type == "application/pdf":
+        return PdfReader is not None and file_size > DOC_PDF_SPLIT_BYTES
+    return file_size > max_tokens * CHARS_PER_TOKEN
+
+
+async def split_document(data: bytes, mime_type: str, max_tokens: int = DOC_CHUNK_TOKENS) -> Optional[List[str]]:
+    """Куски текста для map-reduce или None, если документ можно отправить целиком как есть
+    (он небольшой, не текстовый или текст из него не извлечь)."""
+    if mime_type not in DOCUMENT_MIMES:
+        return None
+    # Разбор PDF — чистый Python: с OFFLOAD_PROCESSES он идёт в процесс
+    return await run_cpu(_split_sections, data, mime_type, max_tokens, size=len(data))
+
+
+def _split_sections(data: bytes, mime_type: str, max_tokens: int) -> Optional[List[str]]:
+    sections = extract_sections(data, mime_type)
+    if sum(estimate_tokens(section) for section in sections) <= max_tokens:
+        return None
+    return pack_sections(sections, max_tokens)
+
+
+async def analyze_chunks(client, prompt: str, chunks: List[str], user_key: Optional[str] = None,
+                         progress: Optional[Progress] = None, concurrency: int = DOC_MAP_CONCURRENCY,
+                         max_tokens: int = DOC_CHUNK_TOKENS,
+                         queue_timeout: Optional[float] = DOC_QUEUE_TIMEOUT) -> str:
+    """Map-reduce по кускам документа.
+
+    Map: каждый кусок разбирается отдельным запросом, одновременно не больше
+    concurrency запросов. Reduce: выдержки объединяются в ответ; если они сами
+    не влезают в бюджет, объединяются группами в несколько уровней.
+    progress(готово, всего) вызывается после каждого запроса. Запрос куска ждёт
+    места в переполненной очереди к прокси до queue_timeout секунд и только потом
+    прерывает разбор QueueFullError.
+    Упавшие куски пропускаются; если не удалось разобрать ни одного, бросается
+    исключение первого из них.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    total = len(chunks)
+    done = 0
+
+    async def run(request_prompt: str) -> str:
+        nonlocal done
+        async with semaphore:
+            try:
+                return await client.generate(request_prompt, user_key=user_key, queue_timeout=queue_timeout)
+            finally:
+                done += 1
+                if progress is not None:
+                    await progress(done, total)
+
+    results = await asyncio.gather(
+        *(run(MAP_PROMPT.format(index=i, total=len(chunks), prompt=prompt, chunk=chunk))
+          for i, chunk in enumerate(chunks, 1)),
+        return_exceptions=True,
+    )
+
+    partials, failed = [], []
+    for i, result in enumerate(results, 1):
+        if isinstance(result, BaseException):
+            if isinstance(result, (QueueFullError, asyncio.CancelledError)):
+                raise result
+            failed.append((i, result))
+        elif result.strip().rstrip(".").upper() != "НЕТ":
+            partials.append(f"--- Часть {i} ---\n{result.strip()}")
+
+    if failed and len(failed) == len(chunks):
+        raise failed[0][1]
+    if not partials:
+        partials.append("В документе не найдено ничего, относящегося к запросу.")
+
+    # Reduce: пока выдержки не помещаются в один запрос, сворачиваем их группами
+    truncated = False
+    while True:
+        text = "\n\n".join(partials)
+        groups = split_text(text, max_tokens)
+        if 1 < len(partials) <= len(groups):
+            # Свёртка не сокращает объём (выдержки длинные) — в последний запрос идут все
+            # выдержки, каждая сокращённая до своей доли бюджета
+            share = max(max_tokens * CHARS_PER_TOKEN // len(partials) - 3, 1)
+            groups = ["\n\n".join(partial if len(partial) <= share else partial[:share] + "…"
+                                   for partial in partials)]
+            truncated = True
+        total += len(groups)
+        answers = await asyncio.gather(*(run(REDUCE_PROMPT.format(prompt=prompt, partials=group)) for group in groups))
+        if len(answers) == 1:
+            answer = answers[0]
+            break
+        partials = [f"--- Часть {i} ---\n{answer.strip()}" for i, answer in enumerate(answers, 1)]
+
+    if truncated:
+        answer += "\n\n(Выдержки из частей документа не поместились в один запрос и были сокращены.)"
+    if failed:
+        numbers = ", ".join(str(i) for i, _ in failed)
+        answer += f"\n\n(Не удалось разобрать части документа: {numbers} из {len(chunks)}.)"
+    return answer
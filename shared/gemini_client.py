@@ -1,42 +1,125 @@
 import os
+import json
 import aiohttp
+import time
 import asyncio
-from typing import List, Dict, Optional
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple, Union
+
+from shared.admission import AdmissionController, QueueFullError, parse_retry_after
+from shared.cache import create_cache, make_cache_key
+from shared.http_session import get_session
+from shared.inline_file import InlineFile, build_payload_body
+from shared.metrics import REGISTRY, STAGE_SECONDS, stage
+from shared.proxy_pool import Endpoint, ProxyPool, parse_proxy_urls
+from shared.resilience import (
+    RETRYABLE, CircuitBreaker, CircuitOpenError, ProxyStatusError, RetryBudget,
+    backoff_delay, classify_error,
+)
+from shared.singleflight import SingleFlight
 
 MAX_RETRIES = 3
 GAS_PROXY_URL = os.getenv("GAS_PROXY_URL")
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+CACHE_LOOKUPS = REGISTRY.counter("gemini_cache_lookups_total", "Обращения к кешу ответов", ("result",))
+PROXY_ERRORS = REGISTRY.counter("gemini_proxy_errors_total", "Неудачные попытки запроса к прокси", ("kind",))
+PROXY_RETRIES = REGISTRY.counter("gemini_proxy_retries_total", "Повторы запросов к прокси", ("kind",))
+
+SYSTEM_INSTRUCTION_TEXT = (
+    "Отвечай всегда на русском языке, если вопрос не содержит другого указания. "
+    "Если есть прикрепленный файл, внимательно его проанализируй. "
+    "Если ответ содержит программный код, **обязательно форматируй его в блок с подсветкой синтаксиса** "
+    "(например, ```python\\nваш_код\\n```). "
+    "**Перед блоком кода** добавь краткое вводное предложение."
+)
+
+
+def _extract_text(data: Dict) -> str:
+    """Достаёт текст из ответа generateContent (все части первого кандидата)."""
+    parts = (data.get("candidates") or [{}])[0].get("content", {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts if not part.get("thought"))
+
+
+def _judge_endpoint(error: BaseException) -> Optional[bool]:
+    """Сетевые сбои, таймауты, 5xx и 429 — проблема развёртывания прокси, 4xx — нет.
+    Прочие ошибки (например, нет свободного слота) к прокси не относятся."""
+    if not isinstance(error, (ProxyStatusError, aiohttp.ClientError, asyncio.TimeoutError)):
+        return None
+    return classify_error(error) not in RETRYABLE
+
+
+def _raise_for_proxy_status(r: aiohttp.ClientResponse):
+    if r.status >= 400:
+        raise ProxyStatusError(r.status, r.reason or "", parse_retry_after(r.headers.get("Retry-After")))
 
 
 class GeminiClient:
-    def __init__(self):
-        self.gas_url = GAS_PROXY_URL
-
-    async def query_gemini(self, prompt: str, file_data: str = None,
-                           mime_type: str = None, history: List[Dict] = None) -> str:
-        """Общая функция для запросов к Gemini (из вашего бота)"""
-        system_instruction_text = (
-            "Отвечай всегда на русском языке, если вопрос не содержит другого указания. "
-            "Если есть прикрепленный файл, внимательно его проанализируй. "
-            "Если ответ содержит программный код, **обязательно форматируй его в блок с подсветкой синтаксиса** "
-            "(например, ```python\\nваш_код\\n```). "
-            "**Перед блоком кода** добавь краткое вводное предложение."
-        )
-
-        contents = history if history else []
-
-        if not history:
-            contents.append({
-                "role": "user",
-                "parts": [{"text": system_instruction_text}]
-            })
+    def __init__(self, gas_url: Optional[str] = None, cache=None,
+                 admission: Optional[AdmissionController] = None):
+        # Можно передать несколько развёртываний прокси через запятую
+        self.pool = ProxyPool(parse_proxy_urls(gas_url or GAS_PROXY_URL))
+        self.cache = cache
+        self.admission = admission or AdmissionController()
+        self.breaker = CircuitBreaker()
+        self.retry_budget = RetryBudget()
+        self._inflight = SingleFlight()
+
+    def export_metrics(self, registry=REGISTRY):
+        """Показывает в /metrics состояние очереди, пула и breaker этого клиента.
+
+        Значения снимаются с самих объектов при запросе /metrics, на горячем пути ничего не добавляется.
+        """
+        registry.gauge_function("gemini_admission_in_flight", "Запросов к прокси в работе",
+                                lambda: self.admission.in_flight)
+        registry.gauge_function("gemini_admission_queued", "Запросов в очереди к прокси",
+                                lambda: self.admission.queued)
+        registry.counter_function("gemini_admission_rejected_total", "Отклонено из-за переполненной очереди",
+                                  lambda: self.admission.rejected)
+        registry.gauge_function("gemini_singleflight_in_flight", "Уникальных запросов в работе",
+                                self._inflight.in_flight)
+        registry.gauge_function("gemini_breaker_open", "Circuit breaker разомкнут (1) или нет (0)",
+                                lambda: int(self.breaker.state != CircuitBreaker.CLOSED))
+        registry.counter_function("gemini_retry_budget_exhausted_total", "Повторов не сделано: бюджет исчерпан",
+                                  lambda: self.retry_budget.exhausted)
+        registry.gauge_function("gemini_proxy_healthy_endpoints", "Живых развёртываний прокси",
+                                self.pool.healthy_count)
+        registry.counter_function("gemini_proxy_hedges_sent_total", "Отправлено дублей медленных запросов",
+                                  lambda: self.pool.hedges_sent)
+        registry.counter_function("gemini_proxy_hedges_won_total", "Дубль ответил раньше оригинала",
+                                  lambda: self.pool.hedges_won)
+
+    @staticmethod
+    def build_payload(prompt: str, file_data: Union[str, InlineFile] = None,
+                      mime_type: str = None, history: List[Dict] = None,
+                      files: List[Tuple[Union[str, InlineFile], str]] = None) -> Dict:
+        """Собирает тело запроса к прокси; переданная история не изменяется.
+
+        history уже должна укладываться в бюджет (см. shared.history_budget).
+
+        file_data — строка base64 или InlineFile (большой файл уходит в прокси потоком).
+        files — несколько файлов парами (данные, mime_type), например альбом.
+        """
+        # Системная инструкция идёт первой в каждом запросе, а не только в первом:
+        # иначе она пропадает из контекста вместе с обрезанным началом истории
+        contents = [{
+            "role": "user",
+            "parts": [{"text": SYSTEM_INSTRUCTION_TEXT}]
+        }]
+        if history:
+            contents.extend(history)
 
         current_user_parts = []
 
+        attachments = list(files) if files else []
         if file_data and mime_type:
+            attachments.append((file_data, mime_type))
+
+        for data, data_mime_type in attachments:
             current_user_parts.append({
                 "inlineData": {
-                    "mimeType": mime_type,
-                    "data": file_data
+                    "mimeType": data_mime_type,
+                    "data": data
                 }
             })
 
@@ -47,45 +130,229 @@ class GeminiClient:
             "parts": current_user_parts
         })
 
-        payload = {
+        return {
             "model": "gemini-2.5-flash",
             "args": {
                 "contents": contents
             }
         }
 
-        for attempt in range(MAX_RETRIES):
+    async def query_gemini(self, prompt: str, file_data: Union[str, InlineFile] = None,
+                           mime_type: str = None, history: List[Dict] = None,
+                           user_key: Optional[str] = None,
+                           files: List[Tuple[Union[str, InlineFile], str]] = None,
+                           queue_timeout: Optional[float] = None) -> str:
+        """Общая функция для запросов к Gemini (из вашего бота)
+
+        user_key — пользователь или чат, по которому запросы честно делятся
+        в очереди к прокси. При переполнении очереди бросает QueueFullError
+        (с queue_timeout — если место не освободилось за столько секунд).
+        Остальные ошибки возвращаются текстом для пользователя.
+        """
+        try:
+            return await self.generate(prompt, file_data, mime_type, history, user_key, files, queue_timeout)
+        except CircuitOpenError as e:
+            return f"⚠️ {e}"
+        except (ProxyStatusError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return f"Ошибка сетевого запроса: {e}"
+        except QueueFullError:
+            raise
+        except Exception as e:
+            return f"Общая ошибка: {e}"
+
+    async def generate(self, prompt: str, file_data: Union[str, InlineFile] = None,
+                       mime_type: str = None, history: List[Dict] = None,
+                       user_key: Optional[str] = None,
+                       files: List[Tuple[Union[str, InlineFile], str]] = None,
+                       queue_timeout: Optional[float] = None) -> str:
+        """Как query_gemini, но ошибки запроса бросаются исключениями.
+
+        Для случаев, когда ответ обрабатывается дальше программно
+        (например, разбор большого документа по частям).
+        """
+        payload = self.build_payload(prompt, file_data, mime_type, history, files)
+
+        request_key = make_cache_key(payload)
+        if self.cache is not None:
+            cached = await self.cache.get(request_key)
+            CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+            if cached is not None:
+                return cached
+
+        # Одинаковые одновременные запросы (пересланное сообщение, двойное нажатие)
+        # идут к прокси одним вызовом
+        with stage("gemini"):
+            return await self._inflight.do(
+                request_key, lambda: self._request(payload, request_key, user_key, queue_timeout)
+            )
+
+    async def _request(self, payload: Dict, request_key: str, user_key: Optional[str],
+                       queue_timeout: Optional[float] = None) -> str:
+        async def post(endpoint: Endpoint, is_hedge: bool):
+            # Дубль запроса не встаёт в очередь: нет свободного слота — нет хеджирования
+            session = await get_session()
+            # Тело собирается до занятия слота: большой JSON сериализуется вне event loop
+            with stage("payload"):
+                body = await build_payload_body(payload)
+            queued_at = time.perf_counter()
+            async with self.admission.slot(user_key, wait=not is_hedge, timeout=queue_timeout):
+                STAGE_SECONDS.observe(time.perf_counter() - queued_at, stage="queue")
+                with stage("proxy"):
+                    async with session.post(endpoint.url, data=body, headers=JSON_HEADERS) as r:
+                        _raise_for_proxy_status(r)
+                        return await r.json()
+
+        data = await self._with_retries(lambda: self.pool.call(post, _judge_endpoint))
+
+        text = _extract_text(data)
+        if text and self.cache is not None:
+            await self.cache.set(request_key, text)
+        return text or data.get("error", "Нет текста в ответе.")
+
+    async def stream_gemini(self, prompt: str, file_data: Union[str, InlineFile] = None,
+                            mime_type: str = None, history: List[Dict] = None,
+                            user_key: Optional[str] = None) -> AsyncIterator[str]:
+        """Потоковый запрос к Gemini: отдаёт фрагменты текста по мере готовности.
+
+        Прокси получает флаг "stream" и отвечает Server-Sent Events в формате
+        streamGenerateContent (строки "data: {...}"). Если прокси не умеет
+        стримить и вернул обычный JSON, весь ответ отдаётся одним фрагментом.
+        Повтор делается только до первого полученного фрагмента.
+        """
+        payload = self.build_payload(prompt, file_data, mime_type, history)
+
+        request_key = make_cache_key(payload)
+        if self.cache is not None:
+            cached = await self.cache.get(request_key)
+            CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+            if cached is not None:
+                yield cached
+                return
+
+        source = lambda: self._stream_request(payload, request_key, user_key)  # noqa: E731
+        # Время до конца потока, включая показ фрагментов вызывающим
+        with stage("gemini"):
+            async for chunk in self._inflight.stream(request_key, source):
+                yield chunk
+
+    async def _stream_request(self, payload: Dict, request_key: str,
+                              user_key: Optional[str]) -> AsyncIterator[str]:
+        payload = dict(payload, stream=True)
+
+        async def open_stream(endpoint: Endpoint, is_hedge: bool):
+            # Слот и соединение остаются открытыми, пока читается поток
+            with stage("payload"):
+                body = await build_payload_body(payload)
+            stack = AsyncExitStack()
+            try:
+                queued_at = time.perf_counter()
+                await stack.enter_async_context(self.admission.slot(user_key))
+                STAGE_SECONDS.observe(time.perf_counter() - queued_at, stage="queue")
+                session = await get_session()
+                # Для потока proxy — время до начала ответа
+                with stage("proxy"):
+                    r = await stack.enter_async_context(
+                        session.post(endpoint.url, data=body, headers=JSON_HEADERS)
+                    )
+                _raise_for_proxy_status(r)
+                return stack, r
+            except BaseException:
+                await stack.aclose()
+                raise
+
+        try:
+            # Поток не хеджируется: дублировать уже идущий ответ бессмысленно
+            stack, r = await self._with_retries(lambda: self.pool.call(open_stream, _judge_endpoint, hedge=False))
+        except CircuitOpenError as e:
+            yield f"⚠️ {e}"
+            return
+        except (ProxyStatusError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            yield f"Ошибка сетевого запроса: {e}"
+            return
+
+        async with stack:
             try:
-                async with aiohttp.ClientSession() as s:
-                    async with s.post(self.gas_url, json=payload, timeout=60) as r:
-                        if r.status >= 500:
-                            if attempt < MAX_RETRIES - 1:
-                                await asyncio.sleep(1)
-                                continue
-                            else:
-                                r.raise_for_status()
-
-                        r.raise_for_status()
-                        data = await r.json()
-
-                        text = (
-                            data.get("candidates", [{}])[0]
-                            .get("content", {})
-                            .get("parts", [{}])[0]
-                            .get("text", "")
-                        )
-                        return text or data.get("error", "Нет текста в ответе.")
+                if r.content_type != "text/event-stream":
+                    data = await r.json(content_type=None)
+                    text = _extract_text(data)
+                    if text and self.cache is not None:
+                        await self.cache.set(request_key, text)
+                    yield text or data.get("error", "Нет текста в ответе.")
+                    return
+
+                chunks = []
+                async for line in r.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    chunk = line[len(b"data:"):].strip()
+                    if not chunk or chunk == b"[DONE]":
+                        continue
+                    text = _extract_text(json.loads(chunk))
+                    if text:
+                        chunks.append(text)
+                        yield text
+
+                if not chunks:
+                    # Поток закончился без текста — ответ тот же, что и без потока
+                    yield "Нет текста в ответе."
+                elif self.cache is not None:
+                    await self.cache.set(request_key, "".join(chunks))
 
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(1)
-                    continue
-                else:
-                    return f"Ошибка сетевого запроса: {e}"
+                # Повтор после начала потока невозможен: часть ответа уже показана
+                yield f"Ошибка сетевого запроса: {e}"
             except Exception as e:
-                return f"Общая ошибка: {e}"
+                yield f"Общая ошибка: {e}"
+
+    async def _with_retries(self, attempt: Callable[[], Awaitable]):
+        """Выполняет попытку с повторами по классу ошибки.
+
+        Повторяются только таймауты, сетевые сбои, 5xx и 429 — с экспоненциальной
+        задержкой и джиттером (или по Retry-After) и только пока есть общий
+        бюджет повторов. Circuit breaker отсекает запросы во время аварии прокси.
+        """
+        self.retry_budget.deposit()
+
+        for n in range(MAX_RETRIES):
+            self.breaker.before_request()
+            try:
+                result = await attempt()
+            except (ProxyStatusError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                kind = classify_error(e)
+                PROXY_ERRORS.inc(kind=kind)
+                if kind in RETRYABLE:
+                    # Пока в пуле есть другие живые развёртывания, сбой одного
+                    # обрабатывается его исключением из пула, а не общим breaker
+                    if self.pool.healthy_count() <= 1:
+                        self.breaker.record_failure()
+                else:
+                    # 4xx — прокси жив, ошибка в самом запросе
+                    self.breaker.record_success()
+
+                if kind not in RETRYABLE or n == MAX_RETRIES - 1 or not self.retry_budget.withdraw():
+                    raise
+
+                PROXY_RETRIES.inc(kind=kind)
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    # Прокси просит подождать — притормаживаем и остальные запросы к нему
+                    self.admission.pause(retry_after)
+                await asyncio.sleep(retry_after or backoff_delay(n))
+            else:
+                self.breaker.record_success()
+                return result
+
 
-        return "Не удалось получить ответ после всех попыток."
+_default_client: Optional[GeminiClient] = None
 
 
-gemini_client = GeminiClient()
\ No newline at end of file
+def __getattr__(name: str):
+    # Общий клиент API-сервера создаётся при первом обращении к gemini_client, а не при
+    # импорте модуля: бот строит свой клиент, и лишний (с открытым кешем) ему не нужен
+    global _default_client
+    if name == "gemini_client":
+        if _default_client is None:
+            _default_client = GeminiClient(cache=create_cache())
+        return _default_client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
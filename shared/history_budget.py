@@ -0,0 +1,157 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from shared.documents import CHARS_PER_TOKEN, estimate_tokens
+from shared.gemini_client import SYSTEM_INSTRUCTION_TEXT
+
+# === НАСТРОЙКИ БЮДЖЕТА ИСТОРИИ ===
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "8000"))
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "0") == "1"
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "600"))
+HISTORY_SUMMARY_CHATS = int(os.getenv("HISTORY_SUMMARY_CHATS", "1000"))
+# ===============================
+
+# Все фоновые сводки делят одну очередь к прокси и не отнимают слоты у запросов пользователей
+SUMMARY_USER_KEY = "history-summary"
+
+SUMMARY_PROMPT = (
+    "Ниже начало диалога пользователя с ассистентом{previous}. Составь краткую сводку, "
+    "не длиннее {words} слов: о чём шла речь, какие были договорённости, факты и открытые вопросы. "
+    "Пиши от третьего лица, без вступлений.\n\n{dialog}"
+)
+SUMMARY_HEADER = "Краткое содержание более ранней части диалога:\n"
+
+
+def message_tokens(message: Dict) -> int:
+    """Оценка размера сообщения contents в токенах (текст и встроенные файлы)."""
+    tokens = 0
+    for part in message.get("parts", []):
+        if "text" in part:
+            tokens += estimate_tokens(part["text"])
+        elif "inlineData" in part:
+            tokens += estimate_tokens(part["inlineData"].get("data") or "")
+    return tokens
+
+
+def trim_history(history: List[Dict], max_tokens: int) -> Tuple[List[Dict], List[Dict]]:
+    """Делит историю на (последние сообщения в пределах max_tokens, отброшенное начало).
+
+    Берутся самые свежие сообщения целиком; оставленная часть начинается
+    с реплики пользователя, чтобы не рвать пары вопрос-ответ.
+    """
+    total = 0
+    start = len(history)
+    while start > 0:
+        size = message_tokens(history[start - 1])
+        if total + size > max_tokens:
+            break
+        total += size
+        start -= 1
+
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+    return history[start:], history[:start]
+
+
+def _fingerprint(message: Dict) -> str:
+    text = "".join(part.get("text", "") for part in message.get("parts", []))
+    return hashlib.sha1(f"{message.get('role')}\0{text}".encode("utf-8")).hexdigest()
+
+
+class HistoryManager:
+    """Собирает историю для запроса в пределах бюджета токенов.
+
+    Системная инструкция добавляется в каждый запрос самим GeminiClient, здесь
+    на неё только резервируется место. Из истории берутся последние реплики,
+    сколько влезает в max_tokens вместе с запросом. С summarize=True то, что
+    не влезло, сжимается фоновым запросом в сводку: она хранится по чату,
+    дополняется по мере выпадения новых реплик и подставляется в начало
+    истории. Пока сводка считается, запрос уходит без неё, не дожидаясь.
+    """
+
+    def __init__(self, client, max_tokens: int = HISTORY_MAX_TOKENS, summarize: bool = HISTORY_SUMMARY,
+                 summary_tokens: int = HISTORY_SUMMARY_TOKENS, max_chats: int = HISTORY_SUMMARY_CHATS):
+        self.client = client
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.max_chats = max_chats
+        self._summaries = OrderedDict()  # key -> (отпечатки свёрнутых реплик, текст сводки)
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    async def prepare(self, key: str, history: List[Dict], prompt: str = "") -> List[Dict]:
+        """История для запроса с текстом prompt: сводка (если есть) и последние реплики."""
+        if not history:
+            # История сброшена или выгружена по неактивности — старая сводка больше не относится к делу
+            self._summaries.pop(key, None)
+            return []
+
+        budget = self.max_tokens - estimate_tokens(prompt) - estimate_tokens(SYSTEM_INSTRUCTION_TEXT)
+        item = self._summaries.get(key)
+        summary = None
+        if item is not None:
+            self._summaries.move_to_end(key)
+            summary = {"role": "user", "parts": [{"text": SUMMARY_HEADER + item[1]}]}
+            budget -= message_tokens(summary)
+
+        kept, dropped = trim_history(history, max(budget, 0))
+        if dropped and self.summarize:
+            self._schedule(key, dropped)
+        return [summary, *kept] if summary else kept
+
+    def reset(self, key: str):
+        self._summaries.pop(key, None)
+        task = self._pending.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def _schedule(self, key: str, dropped: List[Dict]):
+        if key in self._pending:
+            return
+        covered, previous = self._summaries.get(key, (frozenset(), None))
+        fingerprints = [_fingerprint(message) for message in dropped]
+        if all(fingerprint in covered for fingerprint in fingerprints):
+            return
+
+        fresh = [message for message, fingerprint in zip(dropped, fingerprints) if fingerprint not in covered]
+        task = asyncio.create_task(self._summarize(key, fresh, previous, frozenset(fingerprints)))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._forget(key, task))
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._pending.get(key) is task:
+            del self._pending[key]
+
+    async def _summarize(self, key: str, messages: List[Dict], previous: Optional[str], covered: frozenset):
+        lines = []
+        for message in messages:
+            who = "Пользователь" if message.get("role") == "user" else "Ассистент"
+            text = "".join(part.get("text", "") for part in message.get("parts", []))
+            lines.append(f"{who}: {text}")
+        dialog = "\n\n".join(lines)
+        if previous:
+            dialog = f"Прежняя сводка:\n{previous}\n\nДальнейшие реплики:\n{dialog}"
+
+        # Сам запрос на сводку тоже ограничен бюджетом: из очень длинных реплик берём начало
+        max_chars = self.max_tokens * CHARS_PER_TOKEN
+        prompt = SUMMARY_PROMPT.format(
+            previous=" (и сводка его ещё более ранней части)" if previous else "",
+            words=self.summary_tokens // 2,
+            dialog=dialog[:max_chars],
+        )
+        try:
+            summary = await self.client.generate(prompt, user_key=SUMMARY_USER_KEY)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Не удалось сжать историю {key}: {e}")
+            return
+
+        if summary.strip():
+            self._summaries[key] = (covered, summary.strip())
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_chats:
+                self._summaries.popitem(last=False)
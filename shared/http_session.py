@@ -0,0 +1,54 @@
+import asyncio
+import os
+from typing import Optional
+
+import aiohttp
+
+# === НАСТРОЙКИ ПУЛА СОЕДИНЕНИЙ ===
+POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+REQUEST_TIMEOUT = float(os.getenv("HTTP_REQUEST_TIMEOUT", "60"))
+# ===============================
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _create_connector() -> aiohttp.TCPConnector:
+    """Создаёт коннектор с ограничениями пула, keep-alive и кешем DNS."""
+    return aiohttp.TCPConnector(
+        limit=POOL_LIMIT,
+        limit_per_host=POOL_LIMIT_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        enable_cleanup_closed=True,
+    )
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую для процесса сессию, создавая её при первом обращении.
+
+    Сессия привязана к event loop, поэтому при смене цикла создаётся новая.
+    """
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=_create_connector(),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    """Закрывает общую сессию (вызывается при остановке процесса)."""
+    global _session, _session_loop
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
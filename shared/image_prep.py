@@ -0,0 +1,102 @@
+import io
+import os
+import base64
+from typing import Optional, Sequence
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow необязателен: без него картинки уходят как есть
+    Image = None
+
+from shared.offload import run_io
+
+# === НАСТРОЙКИ ПОДГОТОВКИ КАРТИНОК ===
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(2_000_000)))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# ===============================
+
+RESIZABLE_MIMES = {"image/jpeg": "JPEG", "image/png": "PNG"}
+
+
+def can_resize(mime_type: Optional[str]) -> bool:
+    return Image is not None and mime_type in RESIZABLE_MIMES
+
+
+def pick_photo_size(sizes: Sequence, max_pixels: int = IMAGE_MAX_PIXELS):
+    """Из вариантов PhotoSize берёт самый крупный, укладывающийся в max_pixels.
+
+    Больше модели почти ничего не даёт, а скачивать и передавать приходится
+    в разы больше. Если в бюджет не влезает ни один вариант — самый мелкий.
+    """
+    by_pixels = sorted(sizes, key=lambda s: s.width * s.height)
+    fitting = [s for s in by_pixels if s.width * s.height <= max_pixels]
+    return fitting[-1] if fitting else by_pixels[0]
+
+
+def downscale_image(data: bytes, mime_type: str, max_pixels: int = IMAGE_MAX_PIXELS,
+                    quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """Уменьшает PNG/JPEG до max_pixels с сохранением формата.
+
+    Синхронная и тяжёлая для CPU — вызывать через prepare_image, вне event loop.
+    Если уменьшать не нужно или результат не меньше исходника, возвращает data.
+    """
+    if not can_resize(mime_type):
+        return data
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            pixels = image.width * image.height
+            if pixels <= max_pixels:
+                return data
+
+            scale = (max_pixels / pixels) ** 0.5
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            # draft() позволяет декодеру JPEG сразу читать уменьшенную копию
+            image.draft(image.mode, size)
+            resized = ImageOps.exif_transpose(image)
+            # draft() и поворот по EXIF меняют размеры — масштаб считаем заново
+            scale = (max_pixels / (resized.width * resized.height)) ** 0.5
+            if scale < 1:
+                size = (max(1, int(resized.width * scale)), max(1, int(resized.height * scale)))
+                resized = resized.resize(size, Image.LANCZOS)
+
+            fmt = RESIZABLE_MIMES[mime_type]
+            if fmt == "JPEG" and resized.mode not in ("RGB", "L"):
+                resized = resized.convert("RGB")
+
+            out = io.BytesIO()
+            if fmt == "JPEG":
+                resized.save(out, fmt, quality=quality, optimize=True)
+            else:
+                resized.save(out, fmt, optimize=True)
+    except Exception as e:
+        # Битая или экзотическая картинка — пусть модель разбирается с оригиналом
+        print(f"Не удалось уменьшить изображение: {e}")
+        return data
+
+    result = out.getvalue()
+    return result if len(result) < len(data) else data
+
+
+async def prepare_image(data: bytes, mime_type: str) -> bytes:
+    """downscale_image в пуле потоков, чтобы не блокировать event loop.
+
+    Порог OFFLOAD_MIN_BYTES здесь не применяется: и маленький JPEG может
+    оказаться снимком в десятки мегапикселей.
+    """
+    if not can_resize(mime_type):
+        return data
+    return await run_io(downscale_image, data, mime_type)
+
+
+async def prepare_image_base64(file_data: str, mime_type: str) -> str:
+    """То же для base64 из веб-приложения: декодирование и кодирование тоже вне event loop."""
+    if not can_resize(mime_type):
+        return file_data
+
+    def work() -> str:
+        data = base64.b64decode(file_data)
+        resized = downscale_image(data, mime_type)
+        return file_data if resized is data else base64.b64encode(resized).decode("ascii")
+
+    return await run_io(work)
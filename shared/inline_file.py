@@ -0,0 +1,225 @@
+import os
+import json
+import uuid
+import base64
+import hashlib
+import tempfile
+import threading
+from typing import AsyncIterator, Dict, Iterator, Optional, Union
+
+import aiohttp
+
+from shared.offload import OFFLOAD_MIN_BYTES, run_io
+
+# === НАСТРОЙКИ ПРИЁМА ФАЙЛОВ ===
+SPOOL_THRESHOLD = int(os.getenv("FILE_SPOOL_THRESHOLD", str(1024 * 1024)))
+READ_CHUNK_SIZE = 64 * 1024
+BODY_CHUNK_SIZE = 256 * 1024  # кратно 4, чтобы не резать base64-квартеты
+# ===============================
+
+
+class FileTooLargeError(Exception):
+    """Файл больше допустимого размера."""
+
+
+class InlineFile:
+    """Содержимое файла в base64 для inlineData, собираемое по частям.
+
+    Байты кодируются по мере поступления (с переносом остатка до кратного 3),
+    результат копится в SpooledTemporaryFile: в памяти до SPOOL_THRESHOLD,
+    дальше на диске. Параллельно считается sha256 закодированного текста —
+    он совпадает с хешем строки base64 и используется как ключ кеша.
+    """
+
+    def __init__(self, mime_type: str, spool_threshold: int = SPOOL_THRESHOLD):
+        self.mime_type = mime_type
+        self.size = 0  # исходный размер в байтах
+        self.encoded_size = 0
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self._pending = b""
+        self._hash = hashlib.sha256()
+        self._finished = False
+        self._sha256 = None
+        self._lock = threading.Lock()  # seek + read атомарно: файл читают и из потоков (кеш на диске)
+
+    @classmethod
+    def from_bytes(cls, mime_type: str, data: bytes) -> "InlineFile":
+        inline_file = cls(mime_type)
+        inline_file.write(data)
+        inline_file.finish()
+        return inline_file
+
+    @classmethod
+    async def from_bytes_async(cls, mime_type: str, data: bytes) -> "InlineFile":
+        """from_bytes вне event loop, если данных много."""
+        return await run_io(cls.from_bytes, mime_type, data, size=len(data))
+
+    @classmethod
+    def from_encoded_file(cls, mime_type: str, fileobj, size: int, sha256: str) -> "InlineFile":
+        """Оборачивает уже готовый base64 в открытом файле (например, из дискового кеша)."""
+        inline_file = cls(mime_type, spool_threshold=0)
+        inline_file._spool.close()
+        inline_file._spool = fileobj
+        inline_file._spool.seek(0, os.SEEK_END)
+        inline_file.encoded_size = inline_file._spool.tell()
+        inline_file.size = size
+        inline_file._sha256 = sha256
+        inline_file._finished = True
+        return inline_file
+
+    def _append_encoded(self, encoded: bytes):
+        self._spool.write(encoded)
+        self._hash.update(encoded)
+        self.encoded_size += len(encoded)
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        data = self._pending + chunk
+        cut = len(data) - len(data) % 3
+        self._pending = data[cut:]
+        if cut:
+            self._append_encoded(base64.b64encode(data[:cut]))
+
+    def finish(self):
+        if not self._finished:
+            if self._pending:
+                self._append_encoded(base64.b64encode(self._pending))
+                self._pending = b""
+            self._finished = True
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256 or self._hash.hexdigest()
+
+    def iter_encoded(self, chunk_size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+        """Читает base64 по частям. Позиция задаётся перед каждым чтением,
+        поэтому несколько одновременных запросов (повтор, хедж) не мешают друг другу."""
+        position = 0
+        while position < self.encoded_size:
+            with self._lock:
+                self._spool.seek(position)
+                chunk = self._spool.read(chunk_size)
+            position += len(chunk)
+            yield chunk
+
+    def read_base64(self) -> str:
+        """Весь base64 одной строкой — только для небольших файлов."""
+        return b"".join(self.iter_encoded()).decode("ascii")
+
+    def close(self):
+        self._spool.close()
+
+
+async def _iter_download(session: aiohttp.ClientSession, url: str,
+                         max_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Отдаёт тело ответа частями, обрывая загрузку сверх max_size."""
+    async with session.get(url) as r:
+        r.raise_for_status()
+        if max_size and r.content_length and r.content_length > max_size:
+            raise FileTooLargeError(f"Файл больше допустимых {max_size // 1024} КБ")
+        async for chunk in limit_size(r.content.iter_chunked(READ_CHUNK_SIZE), max_size):
+            yield chunk
+
+
+async def limit_size(chunks: AsyncIterator[bytes], max_size: Optional[int]) -> AsyncIterator[bytes]:
+    """Пропускает части, обрывая поток сверх max_size."""
+    received = 0
+    async for chunk in chunks:
+        received += len(chunk)
+        if max_size and received > max_size:
+            raise FileTooLargeError(f"Файл больше допустимых {max_size // 1024} КБ")
+        yield chunk
+
+
+async def encode_stream(chunks: AsyncIterator[bytes], mime_type: str) -> InlineFile:
+    """Кодирует поток байтов в InlineFile по мере поступления, без копии всего файла в памяти.
+
+    Кодирование и запись на диск идут в пуле потоков порциями по OFFLOAD_MIN_BYTES,
+    а не на каждый кусок из сети.
+    """
+    inline_file = InlineFile(mime_type)
+    try:
+        batch, batch_size = [], 0
+        async for chunk in chunks:
+            batch.append(chunk)
+            batch_size += len(chunk)
+            if batch_size >= OFFLOAD_MIN_BYTES:
+                await run_io(inline_file.write, b"".join(batch))
+                batch, batch_size = [], 0
+        if batch:
+            await run_io(inline_file.write, b"".join(batch), size=batch_size)
+        inline_file.finish()
+        return inline_file
+    except BaseException:
+        inline_file.close()
+        raise
+
+
+async def download_inline_file(session: aiohttp.ClientSession, url: str, mime_type: str,
+                               max_size: Optional[int] = None) -> InlineFile:
+    """Скачивает файл частями, сразу кодируя в base64."""
+    return await encode_stream(_iter_download(session, url, max_size), mime_type)
+
+
+async def download_bytes(session: aiohttp.ClientSession, url: str, max_size: Optional[int] = None) -> bytes:
+    """Скачивает файл целиком в память — для того, что всё равно обрабатывается целиком (картинки)."""
+    return b"".join([chunk async for chunk in _iter_download(session, url, max_size)])
+
+
+def payload_body(payload: Dict) -> Union[bytes, AsyncIterator[bytes]]:
+    """Сериализует тело запроса к прокси.
+
+    Без InlineFile это обычный JSON. Если файлы есть, JSON собирается с
+    метками вместо данных и отдаётся потоком: текст JSON вперемешку с
+    base64 из InlineFile, без сборки всего тела в памяти.
+    """
+    files = {}
+
+    def replace(value):
+        if isinstance(value, InlineFile):
+            marker = f"@@inline-{uuid.uuid4().hex}@@"
+            files[marker] = value
+            return marker
+        if isinstance(value, dict):
+            return {k: replace(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [replace(v) for v in value]
+        return value
+
+    text = json.dumps(replace(payload), ensure_ascii=False)
+    if not files:
+        return text.encode("utf-8")
+
+    async def stream() -> AsyncIterator[bytes]:
+        rest = text
+        for marker, inline_file in files.items():
+            before, rest = rest.split(marker, 1)
+            yield before.encode("utf-8")
+            for chunk in inline_file.iter_encoded():
+                yield chunk
+        yield rest.encode("utf-8")
+
+    return stream()
+
+
+def _measure(value) -> int:
+    """Примерный размер JSON без сериализации (InlineFile не считается — он пишется потоком)."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, InlineFile):
+        return 0
+    if isinstance(value, dict):
+        return sum(_measure(item) for item in value.values())
+    if isinstance(value, list):
+        return sum(_measure(item) for item in value)
+    return 8
+
+
+async def build_payload_body(payload: Dict) -> Union[bytes, AsyncIterator[bytes]]:
+    """payload_body вне event loop для больших тел — в пуле потоков.
+
+    Тело без InlineFile (например, base64 строкой из веб-приложения) в процесс не
+    отправляется: копирование многомегабайтной строки туда стоит столько же, сколько
+    сам json.dumps. С InlineFile сериализуется только обвязка.
+    """
+    return await run_io(payload_body, payload, size=_measure(payload))
@@ -0,0 +1,295 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+# === НАСТРОЙКИ МЕТРИК ===
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # /metrics бота в режиме polling; 0 — не поднимать
+# ===============================
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Секунды: от разметки ответа (миллисекунды) до ответа модели на большой файл (минуты)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Метрики обновляются из event loop и из потоков Flask, поэтому у каждой свой замок.
+# Запись — словарь и сложение под незанятым замком: дешевле одного print(), можно
+# держать включёнными постоянно. Текст для Prometheus собирается только по запросу.
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> str:
+        return f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n" + "".join(self._samples())
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Счётчик, который только растёт: повторы, ошибки, попадания в кеш."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}\n"
+
+
+class Gauge(Counter):
+    """Текущее значение: запросы в работе, размер очереди."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по корзинам buckets (секунды)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # ключ -> [счётчики корзин..., +Inf, сумма]
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def totals(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """Число наблюдений и их сумма по значениям меток (для отчётов бенчмарков)."""
+        with self._lock:
+            return {key: (sum(series[:-1]), series[-1]) for key, series in self._series.items()}
+
+    def time(self, **labels) -> _Timer:
+        """with histogram.time(stage="proxy"): ... — замер длительности блока."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}\n"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}\n"
+            yield f"{self.name}_count{labels} {cumulative}\n"
+
+
+class _Function(_Metric):
+    """Значение, которое снимается в момент запроса /metrics (счётчики, которые уже ведут сами объекты)."""
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def _samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        yield f"{self.name} {_format_value(value)}\n"
+
+
+class Registry:
+    """Набор метрик процесса. Повторная регистрация имени возвращает уже созданную метрику."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory: Callable[[], _Metric]) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(name, lambda: Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(name, help, labels, buckets))
+
+    def gauge_function(self, name: str, help: str, fn: Callable[[], float]):
+        """Gauge, значение которого берётся из fn(); новая регистрация заменяет fn."""
+        with self._lock:
+            self._metrics[name] = _Function(name, help, "gauge", fn)
+
+    def counter_function(self, name: str, help: str, fn: Callable[[], float]):
+        with self._lock:
+            self._metrics[name] = _Function(name, help, "counter", fn)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+# Общие для бота и API-сервера метрики. Этап (stage) — часть обработки запроса:
+# download, encode, image_prep, payload, queue, proxy, gemini, render, telegram_send.
+STAGE_SECONDS = REGISTRY.histogram("gemini_bot_stage_seconds", "Длительность этапа обработки запроса", ("stage",))
+HANDLER_SECONDS = REGISTRY.histogram("gemini_bot_handler_seconds", "Полное время обработки запроса", ("handler",))
+HANDLER_TOTAL = REGISTRY.counter("gemini_bot_handled_total", "Обработано запросов", ("handler", "result"))
+HANDLER_IN_FLIGHT = REGISTRY.gauge("gemini_bot_in_flight", "Запросов в обработке", ("handler",))
+
+
+def stage(name: str) -> _Timer:
+    """with stage("download"): ... — время этапа в gemini_bot_stage_seconds."""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def start_request(handler: str) -> float:
+    """Начало запроса handler: он учитывается как выполняющийся. Возвращает время начала для finish_request."""
+    HANDLER_IN_FLIGHT.inc(handler=handler)
+    return time.perf_counter()
+
+
+def finish_request(handler: str, started: float, failed: bool = False):
+    """Конец запроса, начатого start_request: длительность и результат (ok/error)."""
+    HANDLER_IN_FLIGHT.dec(handler=handler)
+    HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler)
+    HANDLER_TOTAL.inc(handler=handler, result="error" if failed else "ok")
+
+
+class track:
+    """Учёт запроса целиком: в обработке, длительность и результат (ok/error).
+
+    Работает и как контекстный менеджер, и как декоратор асинхронной функции.
+    Ошибкой считается исключение из блока или вызов fail() — для обработчиков,
+    которые сами показывают ошибку пользователю и не бросают её дальше.
+    """
+
+    __slots__ = ("handler", "started", "failed")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+    def __enter__(self):
+        self.started = start_request(self.handler)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        finish_request(self.handler, self.started, self.failed or exc_type is not None)
+        return False
+
+    def __call__(self, fn: Callable) -> Callable:
+        handler = self.handler
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with track(handler):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """GET /metrics для aiohttp-приложений."""
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = "0.0.0.0") -> Optional[web.AppRunner]:
+    """Отдельный маленький HTTP-сервер с /metrics (для бота в режиме polling). port=0 — не запускать."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"📈 Метрики на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from shared.metrics import REGISTRY
+
+# === НАСТРОЙКИ ВЫНОСА ТЯЖЁЛОЙ РАБОТЫ ИЗ EVENT LOOP ===
+OFFLOAD_THREADS = int(os.getenv("OFFLOAD_THREADS", "4"))
+OFFLOAD_PROCESSES = int(os.getenv("OFFLOAD_PROCESSES", "0"))  # 0 — чистый Python тоже в потоках
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", str(256 * 1024)))
+OFFLOAD_MIN_CHARS = int(os.getenv("OFFLOAD_MIN_CHARS", "20000"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN = float(os.getenv("LOOP_LAG_WARN", "0.2"))
+# ===============================
+
+# Два вида работы:
+# - io: то, что отпускает GIL (хеши, zlib, файлы, Pillow) или идёт мелкими порциями
+#   (base64 по кускам) — достаточно потока, остальные чаты в это время обслуживаются;
+# - cpu: чистый Python (рендер разметки, разбор PDF) — поток не поможет, нужен процесс.
+#   Аргументы и результат при этом копируются, поэтому в процесс уходит только то,
+#   что сериализуется pickle и стоит дороже своей копии (json.dumps огромной строки —
+#   нет: копия не дешевле самой работы). Без OFFLOAD_PROCESSES такая работа тоже идёт в потоки.
+# Мелкие задачи выполняются на месте: передача в пул дороже их самих.
+
+_threads: Optional[ThreadPoolExecutor] = None
+_processes: Optional[ProcessPoolExecutor] = None
+
+
+def _thread_pool() -> ThreadPoolExecutor:
+    global _threads
+    if _threads is None:
+        _threads = ThreadPoolExecutor(max_workers=OFFLOAD_THREADS, thread_name_prefix="offload")
+    return _threads
+
+
+def _process_pool() -> Optional[ProcessPoolExecutor]:
+    global _processes
+    if _processes is None and OFFLOAD_PROCESSES > 0:
+        _processes = ProcessPoolExecutor(max_workers=OFFLOAD_PROCESSES)
+    return _processes
+
+
+async def run_io(fn: Callable, *args, size: Optional[int] = None, threshold: int = OFFLOAD_MIN_BYTES):
+    """fn(*args) в пуле потоков; если size известен и меньше threshold — на месте."""
+    if size is not None and size < threshold:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_thread_pool(), functools.partial(fn, *args))
+
+
+async def run_cpu(fn: Callable, *args, size: Optional[int] = None, threshold: int = OFFLOAD_MIN_BYTES):
+    """fn(*args) в пуле процессов (или потоков, если процессы выключены); мелкое — на месте.
+
+    fn должна быть функцией уровня модуля, а аргументы и результат — сериализуемыми pickle.
+    """
+    if size is not None and size < threshold:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    pool = _process_pool() or _thread_pool()
+    return await loop.run_in_executor(pool, functools.partial(fn, *args))
+
+
+def shutdown():
+    """Останавливает пулы (при остановке процесса)."""
+    global _threads, _processes
+    if _processes is not None:
+        _processes.shutdown(wait=False, cancel_futures=True)
+        _processes = None
+    if _threads is not None:
+        _threads.shutdown(wait=False, cancel_futures=True)
+        _threads = None
+
+
+class LoopLagMonitor:
+    """Замеряет задержку event loop: насколько позже положенного просыпается sleep.
+
+    Большая задержка значит, что кто-то выполняет синхронную работу прямо в цикле
+    и все остальные чаты в это время ждут. Превышения warn пишутся в лог.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, warn: float = LOOP_LAG_WARN):
+        self.interval = interval
+        self.warn = warn
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - started - self.interval, 0.0)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.warn:
+                self.stalls += 1
+                print(f"Event loop задержан на {lag * 1000:.0f} мс")
+
+
+# Один монитор на процесс: у бота и API-сервера по одному event loop
+loop_monitor = LoopLagMonitor()
+
+REGISTRY.gauge_function("event_loop_lag_seconds", "Последняя замеренная задержка event loop",
+                        lambda: loop_monitor.last_lag)
+REGISTRY.gauge_function("event_loop_lag_max_seconds", "Наибольшая задержка event loop с запуска",
+                        lambda: loop_monitor.max_lag)
+REGISTRY.counter_function("event_loop_stalls_total", "Задержек event loop больше LOOP_LAG_WARN",
+                          lambda: loop_monitor.stalls)
@@ -0,0 +1,155 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+
+# === НАСТРОЙКИ ПУЛА ПРОКСИ ===
+HEDGE_ENABLED = os.getenv("GEMINI_HEDGE", "0") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "2"))
+EJECT_FAILURES = int(os.getenv("GEMINI_EJECT_FAILURES", "3"))
+EJECT_SECONDS = float(os.getenv("GEMINI_EJECT_SECONDS", "30"))
+# ===============================
+
+EWMA_ALPHA = 0.3
+LATENCY_WINDOW = 200
+MIN_SAMPLES_FOR_HEDGE = 20
+
+
+def parse_proxy_urls(value: Optional[str]) -> List[str]:
+    """GAS_PROXY_URL может содержать несколько развёртываний через запятую."""
+    return [url.strip() for url in (value or "").split(",") if url.strip()]
+
+
+class Endpoint:
+    """Одно развёртывание GAS-прокси и его статистика."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = 1.0  # EWMA времени ответа, секунды
+        self.error_rate = 0.0  # EWMA доли ошибок
+        self.in_flight = 0
+        self.failures = 0  # ошибок подряд
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def cost(self) -> float:
+        """Чем меньше, тем охотнее выбираем: медленные, загруженные и сбоящие дороже."""
+        return self.latency * (self.in_flight + 1) * (1 + 4 * self.error_rate)
+
+
+class ProxyPool:
+    """Балансировка между несколькими развёртываниями GAS-прокси.
+
+    Выбор — «два случайных, берём дешевле» по стоимости Endpoint.cost().
+    Развёртывание после EJECT_FAILURES ошибок подряд исключается на
+    EJECT_SECONDS. Если включено хеджирование, запрос, не ответивший за p95
+    недавних задержек, дублируется на другое развёртывание — берётся первый ответ.
+    """
+
+    def __init__(self, urls: List[str], hedge: bool = HEDGE_ENABLED, hedge_min_delay: float = HEDGE_MIN_DELAY,
+                 eject_failures: int = EJECT_FAILURES, eject_seconds: float = EJECT_SECONDS):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def pick(self, exclude: Optional[Endpoint] = None) -> Optional[Endpoint]:
+        if not self.endpoints:
+            raise RuntimeError("Не задан адрес прокси (GAS_PROXY_URL)")
+
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e is not exclude and e.healthy(now)]
+        if not candidates:
+            if exclude is not None:
+                return None
+            # Все исключены — пробуем то, что вернётся в строй раньше всех
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.cost() <= second.cost() else second
+
+    def healthy_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for e in self.endpoints if e.healthy(now))
+
+    def record(self, endpoint: Endpoint, latency: float, ok: bool):
+        endpoint.latency += EWMA_ALPHA * (latency - endpoint.latency)
+        endpoint.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - endpoint.error_rate)
+        if ok:
+            endpoint.failures = 0
+            self._latencies.append(latency)
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_failures:
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+            endpoint.failures = 0
+            print(f"Прокси {endpoint.url} временно исключён из пула после серии ошибок")
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.endpoints) < 2 or len(self._latencies) < MIN_SAMPLES_FOR_HEDGE:
+            return None
+        ordered = sorted(self._latencies)
+        p95 = ordered[int(len(ordered) * 0.95) - 1]
+        return max(self.hedge_min_delay, p95)
+
+    async def call(self, request: Callable[[Endpoint, bool], Awaitable],
+                   judge: Callable[[BaseException], Optional[bool]], hedge: bool = True):
+        """Выполняет request(endpoint, is_hedge) на выбранном развёртывании
+        с учётом статистики и хеджирования.
+
+        judge оценивает исключение: False — сбой развёртывания, True — развёртывание
+        живо (например, 4xx), None — ошибка не связана с прокси и не учитывается.
+        """
+        primary = self.pick()
+        delay = self.hedge_delay() if hedge else None
+        if delay is None:
+            return await self._timed(primary, request, judge, False)
+
+        tasks = [asyncio.ensure_future(self._timed(primary, request, judge, False))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            backup = self.pick(exclude=primary) if not done else None
+            if backup is not None:
+                self.hedges_sent += 1
+                tasks.append(asyncio.ensure_future(self._timed(backup, request, judge, True)))
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _timed(self, endpoint: Endpoint, request, judge, is_hedge: bool):
+        started = time.monotonic()
+        endpoint.in_flight += 1
+        try:
+            result = await request(endpoint, is_hedge)
+        except Exception as e:
+            ok = judge(e)
+            if ok is not None:
+                self.record(endpoint, time.monotonic() - started, ok)
+            raise
+        else:
+            self.record(endpoint, time.monotonic() - started, True)
+            return result
+        finally:
+            endpoint.in_flight -= 1
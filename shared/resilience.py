@@ -0,0 +1,140 @@
+import os
+import time
+import random
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+# === НАСТРОЙКИ ПОВТОРОВ И CIRCUIT BREAKER ===
+BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+BACKOFF_CAP = float(os.getenv("GEMINI_BACKOFF_CAP", "8"))
+RETRY_BUDGET_RATIO = float(os.getenv("GEMINI_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("GEMINI_RETRY_BUDGET_MAX", "20"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("GEMINI_RETRY_BUDGET_MIN_PER_SECOND", "0.1"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("GEMINI_BREAKER_RESET_TIMEOUT", "30"))
+# ===============================
+
+# Классы ошибок запроса к прокси
+TIMEOUT = "timeout"
+NETWORK = "network"
+SERVER = "server"          # 5xx или некорректный ответ прокси
+RATE_LIMIT = "rate_limit"  # 429
+CLIENT = "client"          # прочие 4xx: повтор не поможет
+
+RETRYABLE = {TIMEOUT, NETWORK, SERVER, RATE_LIMIT}
+
+
+class ProxyStatusError(Exception):
+    """Прокси ответил HTTP-статусом ошибки."""
+
+    def __init__(self, status: int, reason: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"{status}, message='{reason}'")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """Circuit breaker разомкнут: прокси считается недоступным, запрос не отправляется."""
+
+
+def classify_error(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return TIMEOUT
+    status = getattr(error, "status", None)
+    if isinstance(error, ProxyStatusError) or isinstance(error, aiohttp.ClientResponseError):
+        if status == 429:
+            return RATE_LIMIT
+        if status is not None and 400 <= status < 500:
+            return CLIENT
+        # 5xx, а также 200 с нечитаемым телом (HTML-страница ошибки Apps Script)
+        return SERVER
+    return NETWORK
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    """Экспоненциальная задержка с полным джиттером: случайно от 0 до min(cap, base * 2^attempt)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryBudget:
+    """Общий для процесса бюджет повторов.
+
+    Каждый запрос пополняет бюджет на ratio, каждый повтор тратит единицу,
+    поэтому во время сбоя повторы добавляют к нагрузке не больше ratio
+    (20% по умолчанию), а не умножают её. Небольшое пополнение по времени
+    оставляет возможность повторять и при редких запросах.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, max_tokens: float = RETRY_BUDGET_MAX,
+                 min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.min_per_second = min_per_second
+        self.tokens = max_tokens
+        self.exhausted = 0
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float):
+        now = time.monotonic()
+        amount += (now - self._updated) * self.min_per_second
+        self._updated = now
+        self.tokens = min(self.max_tokens, self.tokens + amount)
+
+    def deposit(self):
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill(0)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold сбоев подряд и reset_timeout секунд
+    отклоняет запросы сразу. Затем пропускает одну пробную попытку (half-open):
+    успех замыкает цепь, сбой снова размыкает."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+
+    def before_request(self):
+        if self.state == self.CLOSED:
+            return
+
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Прокси Gemini временно недоступен, попробуйте через минуту.")
+            self.state = self.HALF_OPEN
+
+        # Полуоткрытое состояние: одна проба за раз (зависшая проба не блокирует навсегда)
+        if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+            raise CircuitOpenError("Прокси Gemini восстанавливается, попробуйте через минуту.")
+        self._probe_started = now
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = None
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
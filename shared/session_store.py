@@ -0,0 +1,158 @@
+import os
+import time
+import json
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List
+
+# === НАСТРОЙКИ ХРАНИЛИЩА ИСТОРИИ ===
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")  # memory | sqlite
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.sqlite3")
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "40"))
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(24 * 3600)))
+# ===============================
+
+
+class MemorySessionStore:
+    """История диалогов в памяти процесса.
+
+    Хранит последние max_messages сообщений на пользователя (deque с maxlen,
+    поэтому добавление и обрезка O(1)), вытесняет давно неактивных
+    пользователей и ограничивает их общее число (LRU).
+    """
+
+    def __init__(self, max_messages: int = SESSION_MAX_MESSAGES, max_users: int = SESSION_MAX_USERS,
+                 idle_ttl: float = SESSION_IDLE_TTL):
+        self.max_messages = max_messages
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()  # user_id -> (deque сообщений, время последнего обращения)
+
+    def _evict(self, now: float):
+        while self._sessions:
+            user_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_users and now - last_seen < self.idle_ttl:
+                break
+            del self._sessions[user_id]
+
+    async def get(self, user_id) -> List[Dict]:
+        item = self._sessions.get(str(user_id))
+        if item is None or time.monotonic() - item[1] >= self.idle_ttl:
+            return []
+        return list(item[0])
+
+    async def append(self, user_id, *messages: Dict):
+        key = str(user_id)
+        now = time.monotonic()
+        item = self._sessions.pop(key, None)
+        if item is not None and now - item[1] < self.idle_ttl:
+            history = item[0]
+        else:
+            history = deque(maxlen=self.max_messages)
+        history.extend(messages)
+        self._sessions[key] = (history, now)
+        self._evict(now)
+
+    async def reset(self, user_id):
+        self._sessions.pop(str(user_id), None)
+
+
+class SqliteSessionStore:
+    """История диалогов в sqlite (WAL), общая для всех воркеров gunicorn.
+
+    Сообщения пронумерованы по пользователю, поэтому обрезка до последних
+    max_messages — это удаление по диапазону первичного ключа.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, max_messages: int = SESSION_MAX_MESSAGES,
+                 idle_ttl: float = SESSION_IDLE_TTL):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY, last_seq INTEGER NOT NULL, updated REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " user_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, parts TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, seq)) WITHOUT ROWID;"
+        )
+
+    def _get(self, user_id: str) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT m.role, m.parts FROM messages m JOIN sessions s ON s.user_id = m.user_id "
+                "WHERE m.user_id = ? AND s.updated > ? ORDER BY m.seq",
+                (user_id, time.time() - self.idle_ttl),
+            ).fetchall()
+        return [{"role": role, "parts": json.loads(parts)} for role, parts in rows]
+
+    def _append(self, user_id: str, messages):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT last_seq, updated FROM sessions WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                seq = row[0] if row else 0
+                if row and row[1] <= now - self.idle_ttl:
+                    # Сессия устарела: начинаем историю заново
+                    self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                for message in messages:
+                    seq += 1
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO messages (user_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+                        (user_id, seq, message["role"], json.dumps(message["parts"], ensure_ascii=False)),
+                    )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions (user_id, last_seq, updated) VALUES (?, ?, ?)",
+                    (user_id, seq, now),
+                )
+                self._conn.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND seq <= ?", (user_id, seq - self.max_messages)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            # Время от времени удаляем неактивные сессии целиком
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._purge_idle(now)
+
+    def _purge_idle(self, now: float):
+        cutoff = now - self.idle_ttl
+        self._conn.execute(
+            "DELETE FROM messages WHERE user_id IN (SELECT user_id FROM sessions WHERE updated <= ?)", (cutoff,)
+        )
+        self._conn.execute("DELETE FROM sessions WHERE updated <= ?", (cutoff,))
+
+    def _reset(self, user_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    async def get(self, user_id) -> List[Dict]:
+        return await asyncio.to_thread(self._get, str(user_id))
+
+    async def append(self, user_id, *messages: Dict):
+        await asyncio.to_thread(self._append, str(user_id), messages)
+
+    async def reset(self, user_id):
+        await asyncio.to_thread(self._reset, str(user_id))
+
+
+def create_session_store():
+    """Создаёт хранилище истории согласно SESSION_STORE (memory или sqlite)."""
+    if SESSION_STORE == "sqlite":
+        return SqliteSessionStore()
+    return MemorySessionStore()
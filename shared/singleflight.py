@@ -0,0 +1,101 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict
+
+
+class _Call:
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class _StreamCall:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные запросы в один вызов апстрима.
+
+    Все вызывающие с одним ключом ждут общую задачу и получают её результат
+    или исключение. Отмена одного ожидающего не затрагивает остальных;
+    задача отменяется, только когда её перестали ждать все.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamCall] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable]):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(factory()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # Ключ освобождаем сразу: новый вызывающий не должен получить чужую отмену
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Как do(), но для потоковых ответов: подключившийся позже получает
+        уже пришедшие фрагменты, а затем новые по мере поступления."""
+        call = self._streams.get(key)
+        if call is None:
+            call = _StreamCall()
+            self._streams[key] = call
+            call.task = asyncio.ensure_future(self._pump(key, call, factory()))
+
+        call.waiters += 1
+        try:
+            position = 0
+            while True:
+                while position < len(call.chunks):
+                    yield call.chunks[position]
+                    position += 1
+                if call.done:
+                    if call.error is not None:
+                        raise call.error
+                    return
+                async with call.changed:
+                    await call.changed.wait_for(lambda: position < len(call.chunks) or call.done)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(self._streams, key, call)
+                call.task.cancel()
+
+    async def _pump(self, key: str, call: _StreamCall, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                call.chunks.append(chunk)
+                async with call.changed:
+                    call.changed.notify_all()
+        except Exception as e:
+            call.error = e
+        finally:
+            call.done = True
+            self._forget(self._streams, key, call)
+            await source.aclose()
+            async with call.changed:
+                call.changed.notify_all()
+
+    @staticmethod
+    def _forget(calls: Dict, key: str, call):
+        if calls.get(key) is call:
+            del calls[key]
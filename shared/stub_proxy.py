@@ -0,0 +1,141 @@
+import json
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+# Локальная заглушка GAS-прокси для ручных проверок и нагрузочных тестов без квоты Gemini.
+# Отвечает эхом последнего сообщения пользователя; при "stream": true
+# отдаёт ответ частями в формате Server-Sent Events, как streamGenerateContent.
+# Задержка берётся из распределения (--latency), часть запросов может отвечать
+# 500, 429 или зависать, ответ можно дополнить до --answer-size символов.
+# GET /stats — счётчики принятых запросов.
+#
+#   python -m shared.stub_proxy --port 8765 --delay 0.5
+#   python -m shared.stub_proxy --latency lognormal --delay 1.5 --jitter 0.6 --error-rate 0.02
+#   GAS_PROXY_URL=http://127.0.0.1:8765/ python bot/bot.py
+
+FILLER = ("Ответ", "заглушки", "для", "нагрузочного", "теста", "с", "`кодом`", "и", "(скобками).", "\n\n")
+
+
+def _response_json(text: str) -> dict:
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+
+def _answer_for(payload: dict) -> str:
+    contents = payload.get("args", {}).get("contents") or [{}]
+    parts = contents[-1].get("parts") or []
+    prompt = " ".join(part["text"] for part in parts if "text" in part)
+    files = sum(1 for part in parts if "inlineData" in part)
+    suffix = f" (файлов: {files})" if files else ""
+    return f"Эхо: {prompt}{suffix}"
+
+
+def _pad(answer: str, size: int, rng: random.Random) -> str:
+    words = [answer]
+    length = len(answer)
+    while length < size:
+        word = rng.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:max(size, len(answer))]
+
+
+def sample_delay(config: argparse.Namespace, rng: random.Random) -> float:
+    """Задержка до первого байта: delay — среднее (медиана для lognormal), jitter — разброс."""
+    if config.latency == "uniform":
+        return max(rng.uniform(config.delay - config.jitter, config.delay + config.jitter), 0.0)
+    if config.latency == "exponential":
+        return rng.expovariate(1 / config.delay) if config.delay > 0 else 0.0
+    if config.latency == "lognormal":
+        return rng.lognormvariate(0, config.jitter) * config.delay
+    return config.delay
+
+
+async def handle(request: web.Request) -> web.StreamResponse:
+    body = await request.read()
+    payload = json.loads(body)
+    config = request.app["config"]
+    stats = request.app["stats"]
+    rng = request.app["rng"]
+    stats["requests"] += 1
+    stats["bytes_in"] += len(body)
+    answer = _pad(_answer_for(payload), config.answer_size, rng)
+
+    roll = rng.random()
+    if roll < config.timeout_rate:
+        # Зависший запрос: клиент должен отвалиться по своему таймауту
+        stats["hangs"] += 1
+        await asyncio.sleep(config.hang)
+    await asyncio.sleep(sample_delay(config, rng))
+
+    roll -= config.timeout_rate
+    if 0 <= roll < config.error_rate:
+        stats["errors"] += 1
+        return web.json_response({"error": "stub failure"}, status=500)
+    roll -= config.error_rate
+    if 0 <= roll < config.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return web.json_response({"error": "rate limited"}, status=429,
+                                 headers={"Retry-After": str(config.retry_after)})
+
+    if not payload.get("stream"):
+        return web.json_response(_response_json(answer))
+
+    stats["streams"] += 1
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    words = answer.split(" ")
+    try:
+        for i in range(0, len(words), config.chunk_words):
+            chunk = " ".join(words[i:i + config.chunk_words])
+            chunk = chunk if i == 0 else " " + chunk
+            data = json.dumps(_response_json(chunk), ensure_ascii=False)
+            await response.write(f"data: {data}\r\n\r\n".encode("utf-8"))
+            await asyncio.sleep(config.chunk_delay)
+        await response.write_eof()
+    except ConnectionResetError:
+        # Клиент прервал поток (например, все ожидающие отменили запрос)
+        pass
+    return response
+
+
+async def stats(request: web.Request) -> web.Response:
+    return web.json_response(request.app["stats"])
+
+
+def create_app(config: argparse.Namespace) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 ** 2)
+    app["config"] = config
+    app["stats"] = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0, "hangs": 0, "bytes_in": 0}
+    app["rng"] = random.Random(config.seed)
+    app.router.add_post("/", handle)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Заглушка GAS-прокси Gemini")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.5, help="задержка до первого байта, с")
+    parser.add_argument("--latency", choices=("fixed", "uniform", "exponential", "lognormal"), default="fixed",
+                        help="распределение задержки")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="разброс задержки: ± для uniform, sigma для lognormal")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="пауза между SSE-фрагментами, с")
+    parser.add_argument("--chunk-words", type=int, default=1, help="слов в одном SSE-фрагменте")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After в ответах 429, с")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="доля зависающих запросов")
+    parser.add_argument("--hang", type=float, default=120.0, help="на сколько зависает запрос, с")
+    parser.add_argument("--answer-size", type=int, default=0, help="дополнять ответ до стольких символов")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port)
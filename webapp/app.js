@@ -56,7 +56,7 @@ class GeminiApp {
                 this.currentFile = null;
                 document.getElementById('fileName').textContent = '';
             } else {
-                response = await this.sendTextMessage(message);
+                response = await this.sendTextMessage(message, loadingId);
             }
 
             this.updateMessage(loadingId, response);
@@ -65,8 +65,8 @@ class GeminiApp {
         }
     }
 
-    async sendTextMessage(message) {
-        const response = await fetch(`${this.backendUrl}/api/chat`, {
+    async sendTextMessage(message, messageId) {
+        const response = await fetch(`${this.backendUrl}/api/chat/stream`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -75,39 +75,54 @@ class GeminiApp {
             })
         });
 
-        if (!response.ok) throw new Error('Network error');
-        const data = await response.json();
-        return data.response;
+        if (!response.ok || !response.body) throw new Error('Network error');
+
+        // Ответ приходит как Server-Sent Events: показываем текст по мере генерации
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+
+            for (const event of events) {
+                const line = event.split('\n').find(l => l.startsWith('data:'));
+                if (!line) continue;
+
+                const data = JSON.parse(line.slice(5));
+                if (data.error) throw new Error(data.error);
+                if (data.done) return data.response;
+
+                text += data.delta;
+                this.updateMessage(messageId, text);
+            }
+        }
+
+        return text;
     }
 
     async sendFileWithMessage(message) {
-        const reader = new FileReader();
-
-        return new Promise((resolve, reject) => {
-            reader.onload = async (e) => {
-                try {
-                    const base64 = e.target.result.split(',')[1];
-                    const response = await fetch(`${this.backendUrl}/api/upload`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({
-                            user_id: this.userId,
-                            file_data: base64,
-                            mime_type: this.currentFile.type,
-                            prompt: message || 'Опиши этот файл'
-                        })
-                    });
-
-                    if (!response.ok) throw new Error('Upload failed');
-                    const data = await response.json();
-                    resolve(data.response);
-                } catch (error) {
-                    reject(error);
-                }
-            };
-
-            reader.readAsDataURL(this.currentFile);
+        // Файл уходит байтами в multipart, без base64 и без чтения целиком в память страницы.
+        // Поля идут до файла: сервер читает их первыми, а файл — потоком.
+        const form = new FormData();
+        form.append('user_id', this.userId);
+        form.append('prompt', message || 'Опиши этот файл');
+        form.append('file', this.currentFile, this.currentFile.name);
+
+        const response = await fetch(`${this.backendUrl}/api/upload/binary`, {
+            method: 'POST',
+            body: form
         });
+
+        if (!response.ok) throw new Error('Upload failed');
+        const data = await response.json();
+        return data.response;
     }
 
     handleFileSelect(event) {